@@ -4,5 +4,6 @@ __version__ = '.'.join(map(str, VERSION if VERSION[-1] else VERSION[:2]))
 
 from .query import *
 from .behavior import *
+from .codecs import Codec, CodecError, JSONCodec, BinaryCodec
 from .redis import cache
 from .decorators import *
@@ -0,0 +1,397 @@
+'''
+asyncio counterparts of behavior reads: aget, aget_many, aget_all
+(Python 3.5+, redis-py >= 4.2 for 'redis.asyncio').
+Redis is read by asyncio clients (one per node and event loop) built
+from the same CACHEPHOBIA_REDIS, CACHEPHOBIA_REDIS_POOL and replica
+settings as the sync client; keys of sharded config are routed by the
+hash ring of the sync client, reads go to replicas unless read-your-writes
+window of the event loop thread is active. DB misses
+are loaded by sync behavior methods in a thread pool of
+CACHEPHOBIA_ASYNC_WORKERS threads. Concurrent awaits of the same
+key in one event loop share one load.
+Mixins are bases of behaviors, so this module must not import them.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from random import choice
+from threading import Lock
+from time import time
+from weakref import WeakKeyDictionary
+from django.db import close_old_connections
+import six
+from .conf import settings, logger
+from .metrics import metrics
+from .redis import cache, read_your_writes
+from .scripts import get_members
+
+
+_clients = WeakKeyDictionary()
+_inflight = WeakKeyDictionary()
+_executor = None
+_executor_lock = Lock()
+
+
+def make_node(config, pool=None):
+    '''
+    Same as sync 'make_node', replicas are kept in 'cp_replicas'.
+    '''
+    from redis import asyncio as aioredis
+    kwargs = dict(pool or {})
+    replicas = None
+    if isinstance(config, six.string_types):
+        connection_pool = aioredis.ConnectionPool.from_url(config, **kwargs)
+    else:
+        config = dict(config)
+        config.pop('name', None)
+        replicas = config.pop('replicas', None)
+        kwargs.update(config)
+        connection_pool = aioredis.ConnectionPool(**kwargs)
+    client = aioredis.StrictRedis(connection_pool=connection_pool)
+    client.cp_scripts = {}
+    client.cp_replicas = [make_node(replica, pool) for replica in replicas or ()]
+    return client
+
+
+def make_nodes():
+    config = settings.CACHEPHOBIA_REDIS
+    pool = settings.CACHEPHOBIA_REDIS_POOL
+    if isinstance(config, (list, tuple)):
+        return [make_node(node, pool) for node in config]
+    node = make_node(config, pool)
+    node.cp_replicas.extend(make_node(replica, pool)
+                            for replica in settings.CACHEPHOBIA_REDIS_REPLICAS)
+    return [node]
+
+
+def get_client(key):
+    '''
+    Return: asyncio Redis client of current event loop to read 'key'
+            (connections can not be shared between loops)
+    '''
+    loop = asyncio.get_event_loop()
+    nodes = _clients.get(loop)
+    if nodes is None:
+        nodes = _clients[loop] = make_nodes()
+    node = nodes[cache.get_index(key)] if len(nodes) > 1 else nodes[0]
+    if node.cp_replicas and not read_your_writes.active():
+        return choice(node.cp_replicas)
+    return node
+
+
+async def amget(keys, size):
+    '''
+    MGET by chunks of 'size' keys, split by nodes for sharded config.
+    '''
+    if getattr(cache, 'sharded', False):
+        groups = list(cache.group(keys).values())
+    else:
+        groups = [list(enumerate(keys))]
+    result = [None] * len(keys)
+
+    async def read(group):
+        keys = [key for position, key in group]
+        client = get_client(keys[0])
+        if len(keys) > size:
+            pipe = client.pipeline(transaction=False)
+            for i in range(0, len(keys), size):
+                pipe.mget(keys[i:i + size])
+            mcached = [cached for chunk in await pipe.execute() for cached in chunk]
+        else:
+            mcached = await client.mget(keys)
+        for (position, key), cached in zip(group, mcached):
+            result[position] = cached
+
+    if keys:
+        await asyncio.gather(*[read(group) for group in groups])
+    return result
+
+
+def _get_script(client, script):
+    registered = client.cp_scripts.get(script)
+    if registered is None:
+        registered = client.cp_scripts[script] = client.register_script(script.source)
+    return registered
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(settings.CACHEPHOBIA_ASYNC_WORKERS)
+    return _executor
+
+
+def _call(func, args):
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def run_sync(func, *args):
+    '''
+    Run blocking function (DB load) in thread pool.
+    '''
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(), partial(_call, func, args))
+
+
+def coalesce(key, func, *args):
+    '''
+    Run 'func' in thread pool, or join the run for 'key'
+    already in progress in this event loop.
+    Cancellation of one waiter does not cancel shared load.
+    '''
+    loop = asyncio.get_event_loop()
+    inflight = _inflight.get(loop)
+    if inflight is None:
+        inflight = _inflight[loop] = {}
+
+    future = inflight.get(key)
+    if future is None:
+        future = inflight[key] = asyncio.ensure_future(run_sync(func, *args))
+
+        def done(f):
+            if inflight.get(key) is f:
+                del inflight[key]
+        future.add_done_callback(done)
+    return asyncio.shield(future)
+
+
+def _refresh(key, func, *args):
+    '''
+    Refresh in background (early expiration), stale value is returned.
+    '''
+    def done(f):
+        if not f.cancelled() and f.exception() is not None:
+            logger.error('[CACHEPHOBIA] <ASYNC> Refresh of "%s" failed: %r', key, f.exception())
+    coalesce(key, func, *args).add_done_callback(done)
+
+
+def atimed(op):
+    '''
+    Observe latency of async behavior method as 'op'.
+    '''
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if not metrics.enabled:
+                return await method(self, *args, **kwargs)
+            start = time()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                metrics.observe(self._labels, op, time() - start)
+        return wrapper
+    return decorator
+
+
+class AsyncBehavior(object):
+
+    async def _aprefix(self):
+        '''
+        Same as 'prefix', generation is refreshed by async client.
+        '''
+        now = time()
+        if self._generation is None or self._generation_expires < now:
+            generation = await get_client(self._generation_key).get(self._generation_key)
+            self._generation = int(generation or 0)
+            self._generation_expires = now + settings.CACHEPHOBIA_DEFAULTS.get('generation_ttl', 1)
+        return '%s:g%d' % (self.key, self._generation)
+
+    async def _aget_with_pttl(self, key, command='get'):
+        client = get_client(key)
+        if not self.early_expiration:
+            return await getattr(client, command)(key), None
+        pipe = client.pipeline(transaction=False)
+        getattr(pipe, command)(key)
+        pipe.pttl(key)
+        return tuple(await pipe.execute())
+
+
+class LonerAsync(AsyncBehavior):
+
+    @atimed('aget')
+    async def aget(self, pk):
+        key = '%s:%s' % (await self._aprefix(), pk)
+        if self.local is not None:
+            values = self.local.get(key)
+            if values is not None:
+                metrics.incr(self._labels, 'local_hits')
+                return values
+
+        cached, pttl = await self._aget_with_pttl(key)
+        if cached is not None:
+            values = self._deserialize(cached)
+            if values is not None:
+                self._count_reads(1, 0, len(cached))
+                if self._expires_early(pttl):
+                    _refresh(key, self._recompute, key, partial(self._load, pk), None, values)
+                elif self.local is not None:
+                    self.local.set(key, values)
+                return values
+
+        self._count_reads(0, 1)
+        return await coalesce(key, self._recompute, key, partial(self._load, pk),
+                              partial(self._read, key))
+
+    @atimed('aget_many')
+    async def aget_many(self, pks):
+        if len(pks) == 0: return {}
+
+        prefix = await self._aprefix()
+        result = {}
+        pks = tuple(set(pks))
+        keys = ['%s:%s' % (prefix, pk) for pk in pks]
+
+        if self.local is not None:
+            remote_pks, remote_keys = [], []
+            for pk, key in zip(pks, keys):
+                values = self.local.get(key)
+                if values is None:
+                    remote_pks.append(pk)
+                    remote_keys.append(key)
+                else:
+                    result[pk] = values
+            metrics.incr(self._labels, 'local_hits', len(pks) - len(remote_pks))
+            pks, keys = remote_pks, remote_keys
+
+        mcached = await amget(keys, self.batch_size)
+
+        misses = []
+        size = 0
+        for i, cached in enumerate(mcached):
+            values = None if cached is None else self._deserialize(cached)
+            if values is None:
+                misses.append(pks[i])
+            else:
+                size += len(cached)
+                if self.local is not None:
+                    self.local.set(keys[i], values)
+            result[pks[i]] = values
+
+        self._count_reads(len(mcached) - len(misses), len(misses), size)
+
+        if len(misses) > 0:
+            misses.sort(key=str)
+            loaded = await coalesce((prefix,) + tuple(misses), self._load_many, misses)
+            result.update(loaded)
+
+        return result
+
+
+class PrimitiveHerdAsync(AsyncBehavior):
+
+    async def aget(self, pk):
+        all_values = await self.aget_all()
+        return all_values.get(str(pk), None)
+
+    async def aget_many(self, pks):
+        all_values = await self.aget_all()
+        result = {}
+        for pk in pks:
+            result[pk] = all_values.get(str(pk), None)
+        return result
+
+    @atimed('aget_all')
+    async def aget_all(self):
+        key = '%s:all' % (await self._aprefix())
+        cached, pttl = await self._aget_with_pttl(key)
+        if cached is not None:
+            values = self._deserialize(cached)
+            if values is not None:
+                self._count_reads(1, 0, len(cached))
+                if self._expires_early(pttl):
+                    _refresh(key, self._recompute, key, self._load_all, None, values)
+                return values
+
+        self._count_reads(0, 1)
+        return await coalesce(key, self._recompute, key, self._load_all, self._read_all)
+
+
+class IncrementalHerdAsync(PrimitiveHerdAsync):
+
+    async def aget(self, pk):
+        return (await self.aget_many([pk]))[pk]
+
+    @atimed('aget_many')
+    async def aget_many(self, pks):
+        if len(pks) == 0: return {}
+
+        key = '%s:all.hash' % (await self._aprefix())
+        fields = [str(pk) for pk in pks]
+        cached = await get_client(key).hmget(key, [self.MARKER] + fields)
+        if cached[0] is None:
+            return await super(IncrementalHerdAsync, self).aget_many(pks)
+
+        result = {}
+        for pk, blob in zip(pks, cached[1:]):
+            result[pk] = None if blob is None else self._deserialize(blob)
+        self._count_reads(len(pks), 0, sum(len(blob) for blob in cached[1:] if blob))
+        return result
+
+    @atimed('aget_all')
+    async def aget_all(self):
+        key = '%s:all.hash' % (await self._aprefix())
+        cached, pttl = await self._aget_with_pttl(key, 'hgetall')
+        if cached:
+            values = self._decode_all(cached)
+            self._count_reads(1, 0, sum(len(blob) for blob in cached.values()))
+            if self._expires_early(pttl):
+                _refresh(key, self._recompute, key, self._load_all, None, values)
+            return values
+
+        self._count_reads(0, 1)
+        return await coalesce(key, self._recompute, key, self._load_all, self._read_all)
+
+
+class AdvancedHerdAsync(AsyncBehavior):
+
+    @atimed('aget_all')
+    async def aget_all(self):
+        prefix = await self._aprefix()
+        key = '%s:all.ids' % prefix
+        client = get_client(key)
+        if not self.use_script or getattr(cache, 'sharded', False):
+            ids = list(map(int, await client.smembers(key)))
+            if not ids:
+                ids = await coalesce(key, self._load_ids)
+            return await self.aget_many(ids)
+
+        ids, mcached = await _get_script(client, get_members)(keys=[key], args=[prefix])
+        if not ids:
+            return await self.aget_many(await coalesce(key, self._load_ids))
+
+        result = {}
+        misses = []
+        size = 0
+        for pk, cached in zip(map(int, ids), mcached):
+            values = None if cached is None else self._deserialize(cached)
+            if values is None:
+                misses.append(pk)
+            else:
+                size += len(cached)
+            result[pk] = values
+
+        self._count_reads(len(ids) - len(misses), len(misses), size)
+
+        if len(misses) > 0:
+            misses.sort()
+            result.update(await coalesce((prefix,) + tuple(misses), self._load_many, misses))
+
+        return result
+
+
+class HashAsync(object):
+    '''
+    Reads of HashBehavior run in thread pool.
+    '''
+
+    async def aget(self, pk, fields=None):
+        return (await self.aget_many([pk], fields=fields)).get(pk)
+
+    async def aget_many(self, pks, fields=None):
+        return await run_sync(self.get_many, pks, fields)
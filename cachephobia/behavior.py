@@ -1,77 +1,305 @@
+from django.core.exceptions import ValidationError
 from django.db.models.fields.related import RelatedField
-from django.db.models import DateTimeField, DateField, TimeField
-from django.utils.functional import cached_property
+from django.db.models import DateTimeField, DateField, TimeField, DecimalField, UUIDField, Model, Q
+from django.db.models.signals import class_prepared
 from .redis import cache
 from .conf import settings, logger
+from .codecs import CodecError, get_codec, get_compressor, compress, decompress
+from .local import LocalCache
+from .scripts import hset_existing, get_members, sadd_existing, get_groups
+from .metrics import metrics, timed
 import datetime
-from time import mktime
+from time import mktime, time, sleep
+from uuid import uuid4
+from threading import Thread
+from math import log
+from random import random
+from redis.exceptions import LockError
+from functools import wraps
+from itertools import chain
+import six
 import ujson as json
 
+if six.PY3:
+    from .aio import (LonerAsync, PrimitiveHerdAsync, IncrementalHerdAsync,
+                      AdvancedHerdAsync, HashAsync)
+else:
+    # async API is not available
+    class LonerAsync(object): pass
+    class PrimitiveHerdAsync(object): pass
+    class IncrementalHerdAsync(object): pass
+    class AdvancedHerdAsync(object): pass
+    class HashAsync(object): pass
+
+
+def _encode_date(value):
+    if value is None:
+        return None
+    return int(mktime(value.timetuple()))
+
+
+def _encode_iso(value):
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+def _encode_str(value):
+    if value is None:
+        return None
+    return six.text_type(value)
+
+
+def _decode_date(value):
+    if value is None:
+        return None
+    return datetime.date.fromtimestamp(value)
+
+
+def build_field_codec(model):
+    '''
+    Precompile value converters for model fields.
+    Return: (encoders, decoders) where encoders is a tuple of
+            (attname, converter or None) for every field
+            and decoders is a tuple of (attname, converter) only for
+            fields that need conversion.
+    '''
+    encoders = []
+    decoders = []
+    for field in model._meta.fields:
+        if isinstance(field, (DateTimeField, TimeField)):
+            # ISO format keeps microseconds and tz, so instances
+            # built from cached values can be saved back
+            encoders.append((field.attname, _encode_iso))
+            decoders.append((field.attname, field.to_python))
+        elif isinstance(field, DateField):
+            encoders.append((field.attname, _encode_date))
+            decoders.append((field.attname, _decode_date))
+        elif isinstance(field, (DecimalField, UUIDField)):
+            # Not native to codecs, string keeps exact value
+            encoders.append((field.attname, _encode_str))
+            decoders.append((field.attname, field.to_python))
+        else:
+            encoders.append((field.attname, None))
+    return tuple(encoders), tuple(decoders)
+
+
+def with_pipe(method):
+    '''
+    Pass new pipeline as 'pipe' if it is not passed
+    and execute it after method call.
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if kwargs.get('pipe') is not None:
+            return method(self, *args, **kwargs)
+        pipe = cache.pipeline(transaction=False)
+        kwargs['pipe'] = pipe
+        result = method(self, *args, **kwargs)
+        pipe.execute()
+        return result
+    return wrapper
+
 
 class Behavior(object):
     model = None
     key = None
     where = {}
 
-    def __init__(self, timeout=None, where=None):
+    _encoders = ()
+    _decoders = ()
+    _codec = None
+    _load_time = None
+    _labels = ('', '')
+
+    def __init__(self, timeout=None, where=None, codec=None,
+                 single_flight=None, early_expiration=None, capture_ids=None,
+                 compress_threshold=None, compression=None):
+        defaults = settings.CACHEPHOBIA_DEFAULTS
         if timeout is not None:
             self.timeout = timeout
         else:
-            self.timeout = settings.CACHEPHOBIA_DEFAULTS['timeout']
+            self.timeout = defaults['timeout']
         if where is not None:
             self.where = where
+        if codec is not None:
+            self.codec = codec
+        else:
+            self.codec = defaults.get('codec', 'json')
+        if single_flight is not None:
+            self.single_flight = single_flight
+        else:
+            self.single_flight = defaults.get('single_flight', False)
+        if early_expiration is not None:
+            self.early_expiration = early_expiration
+        else:
+            self.early_expiration = defaults.get('early_expiration', 0)
+        self.lock_timeout = defaults.get('lock_timeout', 10)
+        self.batch_size = defaults.get('batch_size', 1000)
+        if capture_ids is not None:
+            self.capture_ids = capture_ids
+        else:
+            self.capture_ids = defaults.get('capture_ids', False)
+        self.lock_wait = defaults.get('lock_wait', 1)
+        if compress_threshold is not None:
+            self.compress_threshold = compress_threshold
+        else:
+            self.compress_threshold = defaults.get('compress_threshold', 0)
+        self._compressor = get_compressor(compression or defaults.get('compression', 'zlib'))
 
     def contribute_to_class(self, model):
         if self.model is None:
             self.model = model
         if self.key is None:
             self.key = model.__name__.lower()
+        self._labels = ('%s.%s' % (model._meta.app_label, model.__name__.lower()),
+                        type(self).__name__)
+        # Fields can be added after the manager, so build
+        # converters when model class is complete
+        class_prepared.connect(self._prepare_model, sender=model, weak=False)
+
+    def _prepare_model(self, sender, **kwargs):
+        self._encoders, self._decoders = build_field_codec(self.model)
+        self._codec = get_codec(self.codec, [attname for attname, c in self._encoders])
 
     def _obj_to_values(self, obj):
         values = {}
-        for field in obj._meta.fields:
-            values[field.attname] = self._convert_for_values(getattr(obj, field.attname))
+        for attname, convert in self._encoders:
+            value = getattr(obj, attname)
+            if convert is None:
+                values[attname] = value
+            else:
+                values[attname] = convert(value)
         return values
 
     def _values_to_obj(self, values):
-        new_values = {}
-        for key, value in values.iteritems():
-            new_values[key] = self._convert_for_obj(key, value)
+        new_values = dict(values)
+        for attname, convert in self._decoders:
+            if attname in new_values:
+                new_values[attname] = convert(new_values[attname])
 
         return self.model(**new_values)
 
-    def _convert_for_values(self, value):
-        if isinstance(value, (datetime.datetime, datetime.date)):
-            return int(mktime(value.timetuple()))
-        elif isinstance(value, datetime.time):
-            return value.strftime("%H:%M")
-        else:
-            return value
+    def _values_to_instance(self, values, using=None):
+        '''
+        Same as _values_to_obj, but instance is marked
+        as loaded from DB 'using'.
+        '''
+        obj = self._values_to_obj(values)
+        obj._state.adding = False
+        obj._state.db = using
+        return obj
 
-    def _convert_for_obj(self, key, value):
-        field = self.model._meta.get_field(key)
-        if isinstance(field, DateTimeField):
-            return datetime.datetime.fromtimestamp(value)
-        elif isinstance(field, DateField):
-            return datetime.date.fromtimestamp(value)
-        elif isinstance(field, TimeField):
-            return datetime.time(*map(int, value.split(':')))
-        else:
-            return value
+    @property
+    def _queryset(self):
+        '''
+        Queryset for DB reads, base manager is used
+        to not be served from cache by CacheQuerySet.
+        '''
+        return self.model._base_manager.all()
 
     def _serialize(self, values):
-        return json.dumps(values)
+        try:
+            data = self._codec.dumps(values)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise CodecError('Values of "%s" can not be encoded: %s' % (self.key, e))
+        return compress(data, self.compress_threshold, self._compressor)
 
     def _deserialize(self, value):
-        return json.loads(value)
+        '''
+        Return: values or None if cached value can not be
+                decoded by current codec (treated as miss)
+        '''
+        try:
+            return self._codec.loads(decompress(value))
+        except ValueError:
+            logger.debug('[CACHEPHOBIA] <DECODE> Value of "%s" can not be decoded by %s codec',
+                         self.key, self._codec.name)
+            return None
+
+    def _recompute(self, key, load, read=None, stale=None):
+        '''
+        Refill cache from DB with stampede protection.
+        With 'single_flight' only one process loads the key, others
+        return 'stale' value or wait up to 'lock_wait' seconds
+        until 'read' finds the new value.
+        Args: key = cache key to refill,
+              load = function that loads values from DB and sets cache,
+              read = function that reads values from cache,
+              stale = values to return if other process is loading
+        '''
+        if not self.single_flight:
+            return self._timed_load(load)
+
+        lock_name = 'cp:lock:%s' % key
+        lock = cache.lock(lock_name, timeout=self.lock_timeout)
+        if lock.acquire(blocking=False):
+            try:
+                return self._timed_load(load)
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+        if stale is not None:
+            return stale
+
+        if read is not None:
+            deadline = time() + self.lock_wait
+            while time() < deadline:
+                sleep(0.02)
+                values = read()
+                if values is not None:
+                    return values
+                if not cache.exists(lock_name):
+                    # Loaded nothing or loader failed
+                    break
+
+        return self._timed_load(load)
+
+    def _timed_load(self, load):
+        start = time()
+        values = load()
+        elapsed = time() - start
+        if self._load_time is None:
+            self._load_time = elapsed
+        else:
+            self._load_time = 0.8 * self._load_time + 0.2 * elapsed
+        return values
+
+    def _expires_early(self, pttl):
+        '''
+        Probabilistic early expiration (XFetch): the closer to expiration
+        and the slower DB load is, the more likely to refresh.
+        Args: pttl = milliseconds to expire
+        '''
+        if not self.early_expiration or pttl is None or pttl < 0 or self._load_time is None:
+            return False
+        return -self._load_time * self.early_expiration * log(1 - random()) * 1000 >= pttl
+
+    def _count_reads(self, hits, misses, size=0):
+        labels = self._labels
+        metrics.incr(labels, 'hits', hits)
+        metrics.incr(labels, 'misses', misses)
+        metrics.incr(labels, 'bytes_read', size)
+
+    def _get_with_pttl(self, key):
+        '''
+        Return: (cached, pttl), pttl is None if early expiration is off
+        '''
+        if not self.early_expiration:
+            return cache.get(key), None
+        pipe = cache.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        return tuple(pipe.execute())
 
     def get(self, pk):
         '''
         Required method.
         Get values from cache, otherwise get values from DB
         and set values in cache.
-        Required, because in future versions it can be implemented
-        in '_fetch_all' queryset method.
         Return: dictionary of values
         '''
         pass
@@ -81,8 +309,8 @@ class Behavior(object):
         Required method.
         Get many values from cache, not found values get from DB
         and set this values in cache.
-        Required, because in future versions it can be implemented
-        in '_fetch_all' queryset method.
+        Required, because it is used in '_fetch_all' queryset method
+        to serve pk lookups from cache.
         Return: {pk: {values}, ...}
         '''
         pass
@@ -108,159 +336,384 @@ class Behavior(object):
         '''
         pass
 
-    def on_save(self, instance, **kwargs):
+    def warm(self, chunk_size=None, progress=None):
+        '''
+        Optional method.
+        Fill cache with all objects matching 'where', rows are
+        streamed from DB and set by 'set_many' in chunks.
+        Args: chunk_size = rows per chunk (default is 'batch_size'),
+              progress = callable(rows) called after every chunk
+        Return: number of cached rows
+        '''
+        return self._warm(lambda chunk: self.set_many(chunk, created=True), chunk_size, progress)
+
+    def _warm(self, set_chunk, chunk_size, progress):
+        size = chunk_size or self.batch_size
+        rows = 0
+        chunk = []
+        for obj in self._queryset.filter(**self.where).iterator():
+            chunk.append(obj)
+            if len(chunk) >= size:
+                set_chunk(chunk)
+                rows += len(chunk)
+                if progress is not None:
+                    progress(len(chunk))
+                chunk = []
+        if chunk:
+            set_chunk(chunk)
+            rows += len(chunk)
+            if progress is not None:
+                progress(len(chunk))
+        return rows
+
+    def on_save(self, instance, pipe=None, **kwargs):
         '''
         Required for cache invalidation.
-        Method that will be called from 'post_save' signal.
+        Method that will be called on model save (hook or 'post_save' signal).
+        All cache writes must go to 'pipe': redis pipeline or
+        transaction Batch (use 'with_pipe' decorator).
         '''
         pass
 
-    def on_delete(self, instance=None, queryset=None, count=None, **kwargs):
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
         '''
         Required for cache invalidation.
-        Method that will be called from custom 'pure_post_delete' signal.
-        'post_delete' is not used to avoid conflicts.
+        Method that will be called on queryset delete (hook or custom
+        'pure_post_delete' signal) and from 'post_delete' signal.
         '''
         pass
 
-    def on_update(self, queryset, **updated):
+    def on_update(self, queryset, pipe=None, **updated):
         '''
         Required for cache invalidation.
-        Method that will be called from custom 'post_update' signal.
+        Method that will be called on queryset update (hook or custom
+        'post_update' signal).
         '''
         pass
 
-    # def invalidate_all(self):
+    # Keys are namespaced by generation counter: '<key>:g<N>:...'.
+    # Full invalidation is one INCR, old keys age out by timeout
+    # or are deleted by reaper.
+
+    _generation = None
+    _generation_expires = 0
+
+    @property
+    def _generation_key(self):
+        return 'cp:gen:%s' % (self.key)
+
+    @property
+    def generation(self):
+        '''
+        Current generation, cached in process for
+        CACHEPHOBIA_DEFAULTS['generation_ttl'] seconds.
+        '''
+        now = time()
+        if self._generation is None or self._generation_expires < now:
+            self._generation = int(cache.get(self._generation_key) or 0)
+            self._generation_expires = now + settings.CACHEPHOBIA_DEFAULTS.get('generation_ttl', 1)
+        return self._generation
+
+    def refresh_generation(self):
+        '''
+        Read generation from Redis before write: after 'invalidate_all'
+        of other process readers are on new generation, and cached one
+        would send the write to keys nobody reads.
+        '''
+        self._generation_expires = 0
+        return self.generation
+
+    @property
+    def prefix(self):
+        return '%s:g%d' % (self.key, self.generation)
+
+    def invalidate_all(self, pipe=None):
         '''
         Any method starting with 'invalidate_' can be used
         from './manage.py invalidate'.
         Args: any arguments, that can be passed through console
         Return: number of invalidated entries
+        Here returns new generation, entries are not counted.
+        With 'pipe' (pipeline or transaction Batch) generation
+        is changed when it is executed and None is returned.
+        '''
+        metrics.incr(self._labels, 'invalidations')
+        if pipe is not None:
+            pipe.incr(self._generation_key)
+            self._generation_expires = 0
+            return None
+        self._generation = cache.incr(self._generation_key)
+        self._generation_expires = time() + settings.CACHEPHOBIA_DEFAULTS.get('generation_ttl', 1)
+        return self._generation
+
+    def invalidate_reap(self, batch=500, delay=0.01, background=False):
         '''
-        # pass
+        Delete keys of old generations with SCAN, 'batch' keys
+        per command with 'delay' seconds pause between batches.
+        Return: number of deleted keys (None if background)
+        '''
+        # Console passes arguments as strings
+        if isinstance(background, six.string_types):
+            background = background.lower() in ('1', 'true', 'yes', 'on')
+        if background:
+            # Not daemon: process exits only after reap is done,
+            # e.g. when called from management command
+            thread = Thread(target=self.reap, args=(int(batch), float(delay)),
+                            name='cachephobia-reaper-%s' % self.key)
+            thread.start()
+            return None
+        return self.reap(int(batch), float(delay))
+
+    def reap(self, batch=500, delay=0.01):
+        current = self.prefix + ':'
+        deleted = 0
+        stale = []
+        for key in cache.scan_iter(match='%s:*' % (self.key), count=batch):
+            if not isinstance(key, str):
+                key = key.decode('utf-8')
+            if not key.startswith(current):
+                stale.append(key)
+            if len(stale) >= batch:
+                deleted += cache.delete(*stale)
+                stale = []
+                sleep(delay)
+        if stale:
+            deleted += cache.delete(*stale)
+        logger.debug('[CACHEPHOBIA] <REAP> Deleted %d keys of "%s"', deleted, self.key)
+        return deleted
 
 
-class LonerBehavior(Behavior):
+class LonerBehavior(LonerAsync, Behavior):
     '''
     To control cache of one object (JSON)
+    Optional 'local' in-process cache of decoded values:
+        local = {'size': <max entries>, 'timeout': <seconds>}
     '''
+    local = None
+
+    def __init__(self, *args, **kwargs):
+        # Keyword only, positional arguments are of Behavior
+        local = kwargs.pop('local', None)
+        super(LonerBehavior, self).__init__(*args, **kwargs)
+        if local is None:
+            local = settings.CACHEPHOBIA_DEFAULTS.get('local')
+        if local is not None:
+            self._local_options = dict(local)
+
+    def contribute_to_class(self, model):
+        super(LonerBehavior, self).contribute_to_class(model)
+        if self.local is None and hasattr(self, '_local_options'):
+            self.local = LocalCache(channel='cp:local:%s' % self.key, **self._local_options)
 
     def _get_key(self, pk):
-        return '%s:%s' % (self.key, pk)
+        return '%s:%s' % (self.prefix, pk)
 
     def _get_keys(self, pks):
+        prefix = self.prefix
         keys = []
         for pk in pks:
-            keys.append('%s:%s' % (self.key, pk))
+            keys.append('%s:%s' % (prefix, pk))
         return keys
 
-    def _delete_by_ids(self, queryset):
+    def _delete_by_ids(self, queryset, pipe):
         ids = queryset.cp_ids
-        if ids is not None:
-            keys = self._get_keys(ids)
-            cache.delete(*keys)
-        else:
+        if ids is None:
             logger.debug('[CACHEPHOBIA] <DELETE/UPDATE> Request without specified IDs that can not be invalidated')
+        elif ids:
+            keys = self._get_keys(ids)
+            pipe.delete(*keys)
+            if self.local is not None:
+                self.local.invalidate(*keys, pipe=pipe)
 
         return ids
 
+    @timed('get')
     def get(self, pk):
-        cached = cache.get(self._get_key(pk))
+        key = self._get_key(pk)
+        if self.local is not None:
+            values = self.local.get(key)
+            if values is not None:
+                metrics.incr(self._labels, 'local_hits')
+                return values
+
+        cached, pttl = self._get_with_pttl(key)
+        if cached is not None:
+            values = self._deserialize(cached)
+            if values is not None:
+                metrics.incr(self._labels, 'hits')
+                metrics.incr(self._labels, 'bytes_read', len(cached))
+                if self._expires_early(pttl):
+                    return self._recompute(key, lambda: self._load(pk), stale=values)
+                if self.local is not None:
+                    self.local.set(key, values)
+                return values
+
+        metrics.incr(self._labels, 'misses')
+        return self._recompute(key, lambda: self._load(pk), read=lambda: self._read(key))
+
+    def _read(self, key):
+        cached = cache.get(key)
         if cached is not None:
-            # cache_read.send(sender=self.model, hit=True)
             return self._deserialize(cached)
+        return None
+
+    def _load(self, pk):
+        metrics.incr(self._labels, 'db_loads')
+        try:
+            obj = self._queryset.get(pk=pk, **self.where)
+        except self.model.DoesNotExist:
+            return None
         else:
-            try:
-                obj = self.model.objects.get(pk=pk, **self.where)
-            except self.model.DoesNotExist:
-                return None
-            else:
-                return self.set(obj)
+            return self.set(obj)
 
+    @timed('get_many')
     def get_many(self, pks):
         if len(pks) == 0: return {}
 
+        result = {}
         pks = tuple(set(pks))
         keys = self._get_keys(pks)
-        mcached = cache.mget(keys)
 
-        result = {}
+        if self.local is not None:
+            remote_pks, remote_keys = [], []
+            for pk, key in zip(pks, keys):
+                values = self.local.get(key)
+                if values is None:
+                    remote_pks.append(pk)
+                    remote_keys.append(key)
+                else:
+                    result[pk] = values
+            metrics.incr(self._labels, 'local_hits', len(pks) - len(remote_pks))
+            pks, keys = remote_pks, remote_keys
+
+        # Long MGET blocks Redis, so keys are requested
+        # by 'batch_size' chunks in one pipeline
+        size = self.batch_size
+        if len(keys) > size:
+            pipe = cache.pipeline(transaction=False)
+            for i in range(0, len(keys), size):
+                pipe.mget(keys[i:i + size])
+            mcached = list(chain.from_iterable(pipe.execute()))
+        else:
+            mcached = cache.mget(keys) if keys else []
+
         misses = []
-        # hit = False
+        size = 0
         for i, cached in enumerate(mcached):
-            if cached is None:
+            values = None if cached is None else self._deserialize(cached)
+            if values is None:
                 misses.append(pks[i])
-                result[pks[i]] = None
             else:
-                result[pks[i]] = self._deserialize(cached)
-                # hit = True
+                size += len(cached)
+                if self.local is not None:
+                    self.local.set(keys[i], values)
+            result[pks[i]] = values
 
-        # if hit:
-        #     cache_read.send(sender=self.model, hit=True)
+        self._count_reads(len(mcached) - len(misses), len(misses), size)
 
         if len(misses) > 0:
-            objs = self.model.objects.filter(pk__in=misses, **self.where)
-            if len(objs) > 0:
-                set_result = self.set_many(objs)
-                result.update(set_result)
+            result.update(self._load_many(misses))
 
         return result
 
+    def _load_many(self, pks):
+        '''
+        Load objects from DB by 'batch_size' chunks and set them in cache.
+        Return: {pk: {values}, ...} of found objects
+        '''
+        result = {}
+        size = self.batch_size
+        for i in range(0, len(pks), size):
+            metrics.incr(self._labels, 'db_loads')
+            objs = self._queryset.filter(pk__in=pks[i:i + size], **self.where)
+            if len(objs) > 0:
+                result.update(self.set_many(objs))
+        return result
+
+    def iter_many(self, pks, **kwargs):
+        '''
+        Same as get_many, but yields results by 'batch_size' chunks.
+        '''
+        seen = set()
+        pks = [pk for pk in pks if not (pk in seen or seen.add(pk))]
+        size = self.batch_size
+        for i in range(0, len(pks), size):
+            yield self.get_many(pks[i:i + size], **kwargs)
+
     def set(self, obj, created=False, pipe=None, extra=None):
         values = self._obj_to_values(obj)
         if extra is not None:
             values.update(extra)
 
+        key = self._get_key(obj.pk)
         serialized = self._serialize(values)
+        metrics.incr(self._labels, 'bytes_written', len(serialized))
         if pipe is None:
-            cache.set(self._get_key(obj.pk), serialized, self.timeout)
+            cache.set(key, serialized, self.timeout)
+            if self.local is not None:
+                self.local.set(key, values)
         else:
-            pipe.set(self._get_key(obj.pk), serialized, self.timeout)
+            # Pipeline can be deferred until transaction commit
+            pipe.set(key, serialized, self.timeout)
 
         return values
 
+    @timed('set_many')
     def set_many(self, objs, created=False, extra=None):
         result = {}
+        size = self.batch_size
         pipe = cache.pipeline()
-        for obj in objs:
-            if obj is not None:
-                result[obj.pk] = self.set(obj, created=created, pipe=pipe, extra=extra)
-            else:
-                result[obj.pk] = None
+        for i, obj in enumerate(objs, 1):
+            if obj is None:
+                continue
+            result[obj.pk] = self.set(obj, created=created, pipe=pipe, extra=extra)
+            if i % size == 0:
+                pipe.execute()
         pipe.execute()
         return result
 
-    def on_save(self, instance, **kwargs):
-        self.set(instance, created=kwargs['created'])
+    @with_pipe
+    def on_save(self, instance, pipe=None, **kwargs):
+        self.set(instance, created=kwargs['created'], pipe=pipe)
+        if self.local is not None and not kwargs['created']:
+            # Drop stale copies in other processes
+            self.local.invalidate(self._get_key(instance.pk), pipe=pipe)
 
-    def on_delete(self, instance=None, queryset=None, count=None, **kwargs):
+    @with_pipe
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
         if queryset is not None:
-            self._delete_by_ids(queryset)
+            self._delete_by_ids(queryset, pipe)
         elif instance is not None:
-            cache.delete(self._get_key(instance.pk))
+            key = self._get_key(instance.pk)
+            pipe.delete(key)
+            if self.local is not None:
+                self.local.invalidate(key, pipe=pipe)
 
-    def on_update(self, queryset, **updated):
-        self._delete_by_ids(queryset)
+    @with_pipe
+    def on_update(self, queryset, pipe=None, **updated):
+        self._delete_by_ids(queryset, pipe)
 
-    def invalidate_all(self):
-        keys = cache.keys('%s:*' % (self.key))
-        if len(keys) > 0:
-            return cache.delete(*keys)
-        return 0
+    def invalidate_all(self, pipe=None):
+        if self.local is not None:
+            self.local.invalidate(pipe=pipe)
+        return super(LonerBehavior, self).invalidate_all(pipe=pipe)
 
     def invalidate_pk(self, pk):
-        return cache.delete(self._get_key(pk))
+        key = self._get_key(pk)
+        if self.local is not None:
+            self.local.invalidate(key)
+        return cache.delete(key)
 
 
-class PrimitiveHerdBehavior(Behavior):
+class PrimitiveHerdBehavior(PrimitiveHerdAsync, Behavior):
     '''
     To control cache of all objects in model (for very small models).
     When often need to get all objects, but rarely to add, delete or update
     '''
 
-    @cached_property
+    @property
     def _key_all(self):
-        return '%s:all' % (self.key)
+        return '%s:all' % (self.prefix)
 
     def get(self, pk):
         all_values = self.get_all()
@@ -273,20 +726,45 @@ class PrimitiveHerdBehavior(Behavior):
             result[pk] = all_values.get(str(pk), None)
         return result
 
+    @timed('get_all')
     def get_all(self):
+        key = self._key_all
+        cached, pttl = self._get_with_pttl(key)
+        if cached is not None:
+            values = self._deserialize(cached)
+            if values is not None:
+                self._count_reads(1, 0, len(cached))
+                if self._expires_early(pttl):
+                    return self._recompute(key, self._load_all, stale=values)
+                return values
+
+        self._count_reads(0, 1)
+        return self._recompute(key, self._load_all, read=self._read_all)
+
+    def _read_all(self):
         cached = cache.get(self._key_all)
         if cached is not None:
-            #cache_read.send(sender=self.model, hit=True)
             return self._deserialize(cached)
-        else:
-            objs = self.model.objects.filter(**self.where)
-            return self.set(objs)
+        return None
+
+    def _load_all(self):
+        metrics.incr(self._labels, 'db_loads')
+        objs = self._queryset.filter(**self.where)
+        return self.set(objs)
+
+    def warm(self, chunk_size=None, progress=None):
+        # Herd is one value, so it is set at once
+        rows = len(self._load_all())
+        if progress is not None:
+            progress(rows)
+        return rows
 
     def set(self, objs, created=False, pipe=None, extra=None):
         values = {}
         for obj in objs:
             values[str(obj.pk)] = self._obj_to_values(obj)
         serialized = self._serialize(values)
+        metrics.incr(self._labels, 'bytes_written', len(serialized))
         if pipe is None:
             cache.set(self._key_all, serialized, self.timeout)
         else:
@@ -294,56 +772,605 @@ class PrimitiveHerdBehavior(Behavior):
 
         return values
 
-    def on_save(self, instance, **kwargs):
-        cache.delete(self._key_all)
+    @with_pipe
+    def on_save(self, instance, pipe=None, **kwargs):
+        pipe.delete(self._key_all)
+
+    @with_pipe
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
+        pipe.delete(self._key_all)
+
+    @with_pipe
+    def on_update(self, queryset, pipe=None, **updated):
+        pipe.delete(self._key_all)
+
+
+class IncrementalHerdBehavior(IncrementalHerdAsync, PrimitiveHerdBehavior):
+    '''
+    Same as PrimitiveHerdBehavior, but all objects are stored as
+    Redis hash (pk -> value), so save and delete patch single entries
+    instead of dropping the whole herd.
+    Hash has marker field to distinguish empty herd from missing.
+    '''
+    MARKER = '.'
+
+    @property
+    def _key_all(self):
+        return '%s:all.hash' % (self.prefix)
+
+    def get(self, pk):
+        return self.get_many([pk])[pk]
+
+    @timed('get_many')
+    def get_many(self, pks):
+        if len(pks) == 0: return {}
+
+        fields = [str(pk) for pk in pks]
+        cached = cache.hmget(self._key_all, [self.MARKER] + fields)
+        if cached[0] is None:
+            return super(IncrementalHerdBehavior, self).get_many(pks)
+
+        result = {}
+        for pk, blob in zip(pks, cached[1:]):
+            result[pk] = None if blob is None else self._deserialize(blob)
+        self._count_reads(len(pks), 0, sum(len(blob) for blob in cached[1:] if blob))
+        return result
+
+    @timed('get_all')
+    def get_all(self):
+        key = self._key_all
+        if self.early_expiration:
+            pipe = cache.pipeline(transaction=False)
+            pipe.hgetall(key)
+            pipe.pttl(key)
+            cached, pttl = pipe.execute()
+        else:
+            cached, pttl = cache.hgetall(key), None
+
+        if cached:
+            values = self._decode_all(cached)
+            self._count_reads(1, 0, sum(len(blob) for blob in cached.values()))
+            if self._expires_early(pttl):
+                return self._recompute(key, self._load_all, stale=values)
+            return values
+
+        self._count_reads(0, 1)
+        return self._recompute(key, self._load_all, read=self._read_all)
+
+    def _decode_all(self, cached):
+        values = {}
+        for pk, blob in six.iteritems(cached):
+            if not isinstance(pk, str):
+                pk = pk.decode('utf-8')
+            if pk != self.MARKER:
+                values[pk] = self._deserialize(blob)
+        return values
+
+    def _read_all(self):
+        cached = cache.hgetall(self._key_all)
+        if cached:
+            return self._decode_all(cached)
+        return None
+
+    def set(self, objs, created=False, pipe=None, extra=None):
+        values = {}
+        mapping = {self.MARKER: ''}
+        for obj in objs:
+            values[str(obj.pk)] = self._obj_to_values(obj)
+            mapping[str(obj.pk)] = self._serialize(values[str(obj.pk)])
+
+        key = self._key_all
+        client = cache.pipeline() if pipe is None else pipe
+        client.delete(key)
+        client.hmset(key, mapping)
+        client.expire(key, self.timeout)
+        if pipe is None:
+            client.execute()
+
+        return values
+
+    def _matches_where(self, instance):
+        '''
+        Return: True/False if instance matches 'where' condition
+                or None if it can not be checked without DB
+        '''
+        for lookup, value in six.iteritems(self.where):
+            if '__' in lookup:
+                return None
+            if getattr(instance, self.model._meta.get_field(lookup).attname) != value:
+                return False
+        return True
+
+    def _patch(self, objs, pipe, removed=()):
+        '''
+        Set values of objects matching 'where', delete others
+        and 'removed' pks from existing herd.
+        '''
+        args = []
+        removed = [str(pk) for pk in removed]
+        for obj in objs:
+            matches = self._matches_where(obj)
+            if matches is None:
+                pipe.delete(self._key_all)
+                return
+            elif matches:
+                args.extend((str(obj.pk), self._serialize(self._obj_to_values(obj))))
+            else:
+                removed.append(str(obj.pk))
 
-    def on_delete(self, instance=None, queryset=None, count=None, **kwargs):
-        cache.delete(self._key_all)
+        if args:
+            hset_existing(keys=[self._key_all], args=args, client=pipe)
+        if removed:
+            pipe.hdel(self._key_all, *removed)
 
-    def on_update(self, queryset, **updated):
-        cache.delete(self._key_all)
+    @with_pipe
+    def on_save(self, instance, pipe=None, **kwargs):
+        self._patch([instance], pipe)
 
-    def invalidate_all(self):
-        return cache.delete(self._key_all)
+    @with_pipe
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
+        if queryset is not None:
+            ids = queryset.cp_ids
+            if ids is None:
+                pipe.delete(self._key_all)
+            elif ids:
+                pipe.hdel(self._key_all, *[str(pk) for pk in ids])
+        elif instance is not None:
+            pipe.hdel(self._key_all, str(instance.pk))
+
+    @with_pipe
+    def on_update(self, queryset, pipe=None, **updated):
+        ids = queryset.cp_ids
+        if ids is None:
+            pipe.delete(self._key_all)
+        elif ids:
+            # Updated objects are reloaded, ones that left
+            # 'where' condition are removed
+            objs = list(self.model._base_manager.using(queryset.db).filter(pk__in=ids))
+            found = set(str(obj.pk) for obj in objs)
+            self._patch(objs, pipe, removed=[pk for pk in ids if str(pk) not in found])
 
 
-class AdvancedHerdBehavior(LonerBehavior):
+class AdvancedHerdBehavior(AdvancedHerdAsync, LonerBehavior):
     '''
     To control cache of all objects in model (for small models).
     When often need to get, add, delete or update objects, but
     sometimes need to get all objects.
+    With 'use_script' ids and values are read by one Lua script call
+    (not used with sharded client, values are on different nodes).
     '''
+    use_script = True
 
-    @cached_property
+    @property
     def _key_all_ids(self):
-        return '%s:all.ids' % (self.key)
+        return '%s:all.ids' % (self.prefix)
 
+    @timed('get_all')
     def get_all(self):
-        ids = map(int, cache.smembers(self._key_all_ids))
+        if not self.use_script or getattr(cache, 'sharded', False):
+            ids = list(map(int, cache.smembers(self._key_all_ids)))
+            if not ids:
+                ids = self._load_ids()
+            return self.get_many(ids)
+
+        prefix = self.prefix
+        ids, mcached = get_members(keys=['%s:all.ids' % prefix], args=[prefix])
         if not ids:
-            ids = self.model.objects.values_list('pk', flat=True).filter(**self.where)
-            cache.sadd(self._key_all_ids, *ids)
-        return self.get_many(ids)
+            return self.get_many(self._load_ids())
+
+        result = {}
+        misses = []
+        size = 0
+        for pk, cached in zip(map(int, ids), mcached):
+            values = None if cached is None else self._deserialize(cached)
+            if values is None:
+                misses.append(pk)
+            else:
+                size += len(cached)
+            result[pk] = values
+
+        self._count_reads(len(ids) - len(misses), len(misses), size)
+
+        if len(misses) > 0:
+            result.update(self._load_many(misses))
+
+        return result
+
+    def _load_ids(self):
+        metrics.incr(self._labels, 'db_loads')
+        ids = list(self._queryset.values_list('pk', flat=True).filter(**self.where))
+        if ids:
+            pipe = cache.pipeline(transaction=False)
+            pipe.sadd(self._key_all_ids, *ids)
+            pipe.expire(self._key_all_ids, self.timeout)
+            pipe.execute()
+        return ids
 
     def set(self, obj, created=False, pipe=None, extra=None):
         values = super(AdvancedHerdBehavior, self).set(obj, created=created, pipe=pipe, extra=extra)
         if created:
-            cache.sadd(self._key_all_ids, obj.pk)
+            # Missing ids set is loaded from DB, new id alone is not all ids
+            sadd_existing(keys=[self._key_all_ids], args=[obj.pk], client=pipe)
         return values
 
-    def set_many(self, objs, created=False, extra=None):
-        result = super(AdvancedHerdBehavior, self).set_many(objs, created=created, extra=extra)
-        if created:
-            cache.sadd(self._key_all_ids, *result.keys())
-        return result
+    def warm(self, chunk_size=None, progress=None):
+        '''
+        Ids are collected in temporary set and merged into ids set
+        after the last chunk, so get_all never reads partial set
+        and ids added meanwhile are kept.
+        '''
+        key = self._key_all_ids
+        # Same hash tag keeps temporary set on node of ids set
+        temp = '%s:warm.%s' % (key if '{' in key else '{%s}' % key, uuid4().hex)
+
+        def set_chunk(chunk):
+            self.set_many(chunk)
+            pipe = cache.pipeline(transaction=False)
+            pipe.sadd(temp, *[obj.pk for obj in chunk])
+            # Leftover of failed warm expires
+            pipe.expire(temp, self.timeout)
+            pipe.execute()
 
-    def on_delete(self, instance=None, queryset=None, count=None, **kwargs):
+        rows = self._warm(set_chunk, chunk_size, progress)
+        if rows:
+            pipe = cache.pipeline(transaction=False)
+            pipe.sunionstore(key, key, temp)
+            pipe.delete(temp)
+            pipe.expire(key, self.timeout)
+            pipe.execute()
+        return rows
+
+    @with_pipe
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
         if queryset is not None:
-            ids = self._delete_by_ids(queryset)
-            cache.srem(self._key_all_ids, ids)
+            ids = self._delete_by_ids(queryset, pipe)
+            if ids:
+                pipe.srem(self._key_all_ids, *ids)
         elif instance is not None:
-            cache.delete(self._get_key(instance.pk))
-            cache.srem(self._key_all_ids, instance.pk)
+            key = self._get_key(instance.pk)
+            pipe.delete(key)
+            pipe.srem(self._key_all_ids, instance.pk)
+            if self.local is not None:
+                self.local.invalidate(key, pipe=pipe)
 
     def invalidate_idslist(self):
         return cache.delete(self._key_all_ids)
+
+
+class HashBehavior(HashAsync, LonerBehavior):
+    '''
+    To control cache of one object stored as Redis hash (field -> JSON).
+    Allows to read only needed fields and to update fields in place.
+    Fields can be a list of attnames or a name of model SERIALIZERS.
+    '''
+
+    def _resolve_fields(self, fields):
+        if isinstance(fields, six.string_types):
+            fields = self.model.SERIALIZERS[fields][1]
+        if fields is not None:
+            fields = tuple(fields)
+        return fields
+
+    def _project(self, values, fields):
+        if values is None or fields is None:
+            return values
+        return dict((field, values[field]) for field in fields)
+
+    def get(self, pk, fields=None):
+        return self.get_many([pk], fields=fields).get(pk)
+
+    @timed('get_many')
+    def get_many(self, pks, fields=None):
+        if len(pks) == 0: return {}
+
+        fields = self._resolve_fields(fields)
+        result = {}
+        pks = tuple(set(pks))
+        keys = self._get_keys(pks)
+
+        if self.local is not None:
+            remote_pks, remote_keys = [], []
+            for pk, key in zip(pks, keys):
+                values = self.local.get(key)
+                if values is None:
+                    remote_pks.append(pk)
+                    remote_keys.append(key)
+                else:
+                    result[pk] = self._project(values, fields)
+            metrics.incr(self._labels, 'local_hits', len(pks) - len(remote_pks))
+            pks, keys = remote_pks, remote_keys
+
+        pipe = cache.pipeline(transaction=False)
+        for key in keys:
+            if fields is None:
+                pipe.hgetall(key)
+            else:
+                pipe.hmget(key, fields)
+        rows = pipe.execute() if keys else []
+
+        misses = []
+        for pk, key, row in zip(pks, keys, rows):
+            if fields is None:
+                values = dict((f.decode('utf-8') if isinstance(f, bytes) else f, json.loads(v))
+                              for f, v in six.iteritems(row)) if row else None
+                if values is not None and self.local is not None:
+                    self.local.set(key, values)
+            elif None in row:
+                # Every field is stored, so missing field means missing
+                # hash or hash expired/deleted between fields
+                values = None
+            else:
+                values = dict(zip(fields, map(json.loads, row)))
+            if values is None:
+                misses.append(pk)
+            result[pk] = values
+
+        self._count_reads(len(rows) - len(misses), len(misses))
+
+        if len(misses) > 0:
+            for pk, values in six.iteritems(self._load_many(misses)):
+                result[pk] = self._project(values, fields)
+
+        return result
+
+    def set(self, obj, created=False, pipe=None, extra=None):
+        values = self._obj_to_values(obj)
+        if extra is not None:
+            values.update(extra)
+
+        key = self._get_key(obj.pk)
+        try:
+            mapping = dict((field, json.dumps(value)) for field, value in six.iteritems(values))
+        except (TypeError, OverflowError) as e:
+            raise CodecError('Values of "%s" can not be encoded: %s' % (self.key, e))
+        client = cache.pipeline() if pipe is None else pipe
+        client.hmset(key, mapping)
+        client.expire(key, self.timeout)
+        if pipe is None:
+            client.execute()
+            if self.local is not None:
+                self.local.set(key, values)
+
+        return values
+
+    def _update_fields(self, ids, updated, pipe):
+        '''
+        Update cached hashes in place.
+        Return: False if update can not be applied to cached values
+        '''
+        encoders = dict(self._encoders)
+        where_fields = set(lookup.split('__')[0] for lookup in self.where)
+        args = []
+        for name, value in six.iteritems(updated):
+            # Object can leave 'where' condition or value is unknown
+            if name in where_fields or hasattr(value, 'resolve_expression'):
+                return False
+            field = self.model._meta.get_field(name)
+            if isinstance(value, Model):
+                value = value.pk
+            convert = encoders.get(field.attname)
+            try:
+                # Raw values of update(), e.g. strings for dates
+                value = field.to_python(value)
+                if convert is not None:
+                    value = convert(value)
+                encoded = json.dumps(value)
+            except (ValidationError, ValueError, TypeError, OverflowError):
+                return False
+            args.extend((field.attname, encoded))
+
+        if args:
+            keys = self._get_keys(ids)
+            hset_existing(keys=keys, args=args, client=pipe)
+            if self.local is not None:
+                self.local.invalidate(*keys, pipe=pipe)
+        return True
+
+    @with_pipe
+    def on_update(self, queryset, pipe=None, **updated):
+        ids = queryset.cp_ids
+        if not ids or not self._update_fields(ids, updated, pipe):
+            self._delete_by_ids(queryset, pipe)
+
+
+class IndexBehavior(LonerBehavior):
+    '''
+    Same as LonerBehavior, plus Redis sets of pks grouped by values
+    of 'index' fields (foreign keys), to get whole groups by
+    'get_by' without SQL.
+    Sets are built from DB on the first read and patched on writes.
+    Pk that left the group stays in set until read, members are
+    checked against their values and stale ones are removed.
+    With 'use_script' groups and values are read by one Lua script call.
+    '''
+    MARKER = '.'
+    use_script = True
+
+    def __init__(self, *args, **kwargs):
+        # Keyword only, positional arguments are of Behavior
+        index = kwargs.pop('index', ())
+        super(IndexBehavior, self).__init__(*args, **kwargs)
+        if isinstance(index, six.string_types):
+            index = (index,)
+        self.index = tuple(index)
+
+    def _prepare_model(self, sender, **kwargs):
+        super(IndexBehavior, self)._prepare_model(sender, **kwargs)
+        # Field name and attname -> attname
+        self._index_fields = {}
+        for name in self.index:
+            field = self.model._meta.get_field(name)
+            self._index_fields[field.name] = field.attname
+            self._index_fields[field.attname] = field.attname
+
+    def _index_key(self, attname, value, prefix=None):
+        if isinstance(value, Model):
+            value = value.pk
+        if value is None:
+            # Not '...:None', it is a valid value of char field
+            return '%s:idx.null:%s' % (prefix or self.prefix, attname)
+        return '%s:idx:%s:%s' % (prefix or self.prefix, attname, value)
+
+    @staticmethod
+    def _group_value(value):
+        '''
+        Return: value of group comparable with values from DB and cache
+        '''
+        if isinstance(value, Model):
+            value = value.pk
+        return None if value is None else six.text_type(value)
+
+    def _index_attname(self, field):
+        try:
+            return self._index_fields[field]
+        except KeyError:
+            raise ValueError('Field "%s" of %s is not indexed' % (field, self.model.__name__))
+
+    @timed('get_by')
+    def get_by(self, field, values):
+        '''
+        Args: field = name or attname of indexed field,
+              values = values of field (or model instances)
+        Return: {value: {pk: {values}, ...}, ...}
+        '''
+        attname = self._index_attname(field)
+        values = list(values)
+        if not values: return {}
+
+        prefix = self.prefix
+        keys = [self._index_key(attname, value, prefix) for value in values]
+        if self.use_script and not getattr(cache, 'sharded', False):
+            groups, rows, missing = self._read_groups(keys, values, prefix)
+        else:
+            pipe = cache.pipeline(transaction=False)
+            for key in keys:
+                pipe.smembers(key)
+            groups = {}
+            missing = []
+            for value, members in zip(values, pipe.execute()):
+                if members:
+                    pks = [self._parse_pk(pk) for pk in members]
+                    groups[value] = [pk for pk in pks if pk != self.MARKER]
+                else:
+                    missing.append(value)
+            rows = {}
+
+        if missing:
+            metrics.incr(self._labels, 'misses', len(missing))
+            groups.update(self._load_groups(attname, missing, prefix))
+
+        wanted = set(pk for pks in groups.values() for pk in pks if pk not in rows)
+        if wanted:
+            rows.update(self.get_many(list(wanted)))
+
+        result = {}
+        stale = []
+        for value, pks in six.iteritems(groups):
+            expected = self._group_value(value)
+            group = result[value] = {}
+            for pk in pks:
+                row = rows.get(pk)
+                if row is None or self._group_value(row.get(attname)) != expected:
+                    stale.append((self._index_key(attname, value, prefix), pk))
+                else:
+                    group[pk] = row
+
+        if stale:
+            pipe = cache.pipeline(transaction=False)
+            for key, pk in stale:
+                pipe.srem(key, pk)
+            pipe.execute()
+        return result
+
+    def _parse_pk(self, pk):
+        if isinstance(pk, bytes):
+            pk = pk.decode('utf-8')
+        if pk == self.MARKER:
+            return pk
+        return self.model._meta.pk.to_python(pk)
+
+    def _read_groups(self, keys, values, prefix):
+        '''
+        Return: ({value: [pk, ...]}, {pk: {values}}, [values of missing sets])
+        '''
+        reply = get_groups(keys=keys, args=[prefix, self.MARKER])
+        groups = {}
+        rows = {}
+        missing = []
+        hits = 0
+        size = 0
+        for i, value in enumerate(values):
+            exists, ids, blobs = reply[i * 3:i * 3 + 3]
+            if not exists:
+                missing.append(value)
+                continue
+            pks = groups[value] = []
+            for pk, blob in zip(ids, blobs):
+                pk = self._parse_pk(pk)
+                pks.append(pk)
+                row = None if blob is None else self._deserialize(blob)
+                if row is not None:
+                    rows[pk] = row
+                    hits += 1
+                    size += len(blob)
+        self._count_reads(hits, 0, size)
+        return groups, rows, missing
+
+    def _load_groups(self, attname, values, prefix):
+        '''
+        Load pks of groups from DB and set index sets.
+        Return: {value: [pk, ...]}
+        '''
+        metrics.incr(self._labels, 'db_loads')
+        by_key = dict((self._group_value(value), value) for value in values)
+        groups = dict((value, []) for value in values)
+        condition = Q(**{'%s__in' % attname: [key for key in by_key if key is not None]})
+        if None in by_key:
+            condition |= Q(**{'%s__isnull' % attname: True})
+        queryset = self._queryset.filter(condition, **self.where)
+        for group, pk in queryset.values_list(attname, 'pk').iterator():
+            groups[by_key[self._group_value(group)]].append(pk)
+
+        pipe = cache.pipeline(transaction=False)
+        for value, pks in six.iteritems(groups):
+            key = self._index_key(attname, value, prefix)
+            pipe.delete(key)
+            pipe.sadd(key, self.MARKER, *pks)
+            pipe.expire(key, self.timeout)
+        pipe.execute()
+        return groups
+
+    @with_pipe
+    def on_save(self, instance, pipe=None, **kwargs):
+        super(IndexBehavior, self).on_save(instance, pipe=pipe, **kwargs)
+        keys = [self._index_key(attname, getattr(instance, attname))
+                for attname in set(self._index_fields.values())]
+        if keys:
+            sadd_existing(keys=keys, args=[instance.pk], client=pipe)
+
+    @with_pipe
+    def on_delete(self, instance=None, queryset=None, count=None, pipe=None, **kwargs):
+        super(IndexBehavior, self).on_delete(instance=instance, queryset=queryset,
+                                             count=count, pipe=pipe, **kwargs)
+        # Members deleted by queryset are removed on read
+        if instance is not None:
+            for attname in set(self._index_fields.values()):
+                pipe.srem(self._index_key(attname, getattr(instance, attname)), instance.pk)
+
+    @with_pipe
+    def on_update(self, queryset, pipe=None, **updated):
+        super(IndexBehavior, self).on_update(queryset, pipe=pipe, **updated)
+        ids = queryset.cp_ids
+        for name, value in six.iteritems(updated):
+            attname = self._index_fields.get(name)
+            if attname is None:
+                continue
+            if hasattr(value, 'resolve_expression'):
+                # New groups are unknown
+                self.invalidate_all(pipe=pipe)
+                return
+            key = self._index_key(attname, value)
+            if ids is None:
+                pipe.delete(key)
+            elif ids:
+                sadd_existing(keys=[key], args=list(ids), client=pipe)
@@ -0,0 +1,259 @@
+'''
+Micro-benchmarks of cachephobia internals.
+Run: python -m cachephobia.bench [name ...]
+Uses project settings if DJANGO_SETTINGS_MODULE is set,
+otherwise configures minimal in-memory settings.
+Benchmarks of write path need Redis from CACHEPHOBIA_REDIS.
+'''
+from __future__ import print_function
+import datetime
+import sys
+import time
+
+
+def setup():
+    import django
+    from django.conf import settings as django_settings
+    if not django_settings.configured:
+        import os
+        if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+            django_settings.configure(
+                DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                       'NAME': ':memory:'}},
+                INSTALLED_APPS=[],
+            )
+    django.setup()
+
+
+def make_model(name='BenchRow', **extra):
+    from django.db import models
+
+    class Meta:
+        app_label = 'cachephobia_bench'
+
+    attrs = {
+        '__module__': __name__,
+        'Meta': Meta,
+        'id': models.AutoField(primary_key=True),
+        'lastname': models.CharField(max_length=50),
+        'firstname': models.CharField(max_length=50),
+        'phone': models.CharField(max_length=16, blank=True),
+        'mail': models.EmailField(max_length=80, blank=True),
+        'birthday': models.DateField(null=True, default=None, blank=True),
+        'debt': models.IntegerField(default=0),
+        'comment': models.CharField(max_length=255, blank=True),
+        'status': models.CharField(max_length=1, default='a'),
+        'create_time': models.DateTimeField(),
+        'creator': models.CharField(max_length=50),
+    }
+    attrs.update(extra)
+    return type(name, (models.Model,), attrs)
+
+
+def create_table(model):
+    from django.db import connection
+    with connection.schema_editor() as editor:
+        editor.create_model(model)
+
+
+def make_objs(model, count):
+    now = datetime.datetime(2016, 5, 1, 12, 30)
+    return [model(id=i, lastname='Lastname%d' % i, firstname='Firstname',
+                  phone='+79990000000', mail='mail%d@example.com' % i,
+                  birthday=datetime.date(1990, 1, 1), debt=i % 100,
+                  comment='', status='a', create_time=now, creator='admin')
+            for i in range(1, count + 1)]
+
+
+def measure(func, rows, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return rows / best if best else float('inf')
+
+
+def report(title, results):
+    print(title)
+    base = None
+    for name, rate in results:
+        if base is None:
+            base = rate
+        print('  %-24s %12.0f rows/sec  x%.2f' % (name, rate, rate / base))
+
+
+class LegacyConverter(object):
+    '''
+    Per-call field lookup (implementation before precompiled codec)
+    '''
+
+    def __init__(self, model):
+        self.model = model
+
+    def _obj_to_values(self, obj):
+        values = {}
+        for field in obj._meta.fields:
+            value = getattr(obj, field.attname)
+            if isinstance(value, (datetime.datetime, datetime.date)):
+                value = int(time.mktime(value.timetuple()))
+            elif isinstance(value, datetime.time):
+                value = value.strftime('%H:%M')
+            values[field.attname] = value
+        return values
+
+    def _values_to_obj(self, values):
+        from django.db.models import DateTimeField, DateField, TimeField
+        new_values = {}
+        for key, value in values.items():
+            field = self.model._meta.get_field(key)
+            if value is None:
+                pass
+            elif isinstance(field, DateTimeField):
+                value = datetime.datetime.fromtimestamp(value)
+            elif isinstance(field, DateField):
+                value = datetime.date.fromtimestamp(value)
+            elif isinstance(field, TimeField):
+                value = datetime.time(*map(int, value.split(':')))
+            new_values[key] = value
+        return self.model(**new_values)
+
+
+def bench_codec(rows=5000):
+    from .behavior import LonerBehavior
+
+    model = make_model('CodecRow')
+    behavior = LonerBehavior()
+    behavior.contribute_to_class(model)
+    behavior._prepare_model(model)
+    legacy = LegacyConverter(model)
+
+    objs = make_objs(model, rows)
+    values = [behavior._obj_to_values(obj) for obj in objs]
+
+    report('obj -> values', [
+        ('per-call lookup', measure(lambda: [legacy._obj_to_values(o) for o in objs], rows)),
+        ('precompiled', measure(lambda: [behavior._obj_to_values(o) for o in objs], rows)),
+    ])
+    report('values -> obj', [
+        ('per-call lookup', measure(lambda: [legacy._values_to_obj(v) for v in values], rows)),
+        ('precompiled', measure(lambda: [behavior._values_to_obj(v) for v in values], rows)),
+    ])
+
+
+def bench_serialize(rows=5000):
+    from .behavior import LonerBehavior
+
+    model = make_model('SerializeRow')
+    objs = make_objs(model, rows)
+    results = []
+    sizes = []
+    for codec in ('json', 'binary'):
+        behavior = LonerBehavior(codec=codec)
+        behavior.contribute_to_class(model)
+        behavior._prepare_model(model)
+        values = [behavior._obj_to_values(obj) for obj in objs]
+        blobs = [behavior._serialize(v) for v in values]
+        sizes.append((codec, sum(len(b) for b in blobs) / float(rows)))
+        results.append((codec + ' dumps', measure(lambda: [behavior._serialize(v) for v in values], rows)))
+        results.append((codec + ' loads', measure(lambda: [behavior._deserialize(b) for b in blobs], rows)))
+
+    report('serialize', results)
+    for codec, size in sizes:
+        print('  %-24s %12.1f bytes/row' % (codec, size))
+
+
+def bench_compression(rows=5000):
+    '''
+    Size and speed of compressed herd blob (all rows in one value,
+    as stored by PrimitiveHerdBehavior) and of single row blobs.
+    '''
+    from .behavior import LonerBehavior
+    from .codecs import COMPRESSORS, ZlibCompressor, compress, decompress, lz4
+
+    model = make_model('CompressRow')
+    objs = make_objs(model, rows)
+    compressors = [('zlib-1', ZlibCompressor(1)), ('zlib-6', ZlibCompressor(6))]
+    if lz4 is not None:
+        compressors.append(('lz4', COMPRESSORS['lz4']()))
+
+    for codec in ('json', 'binary'):
+        behavior = LonerBehavior(codec=codec)
+        behavior.contribute_to_class(model)
+        behavior._prepare_model(model)
+        herd = dict((str(obj.pk), behavior._obj_to_values(obj)) for obj in objs)
+        blob = behavior._codec.dumps(herd)
+        if not isinstance(blob, bytes):
+            blob = blob.encode('utf-8')
+        row = behavior._codec.dumps(behavior._obj_to_values(objs[0]))
+
+        results = [('plain loads', measure(lambda: behavior._codec.loads(blob), rows))]
+        sizes = [('plain', len(blob), len(row))]
+        for name, compressor in compressors:
+            packed = compress(blob, 1, compressor)
+            results.append((name + ' dumps', measure(lambda: compress(behavior._codec.dumps(herd), 1, compressor), rows)))
+            results.append((name + ' loads', measure(lambda: behavior._codec.loads(decompress(packed)), rows)))
+            sizes.append((name, len(packed), len(compress(row, 1, compressor))))
+
+        report('compression of %d rows herd, %s' % (rows, codec), results)
+        for name, size, row_size in sizes:
+            print('  %-24s %12d bytes  %6d bytes/row blob' % (name, size, row_size))
+
+
+def bench_writes(rows=2000, chunk=100):
+    '''
+    Bulk updates by pk chunks and single saves of cached model
+    with direct hooks, with signal dispatch and without cache.
+    '''
+    from django.conf import settings as django_settings
+    from django.db import models
+    from .behavior import LonerBehavior
+    from .query import CacheManager
+
+    variants = []
+    for name, signals in (('hooks', False), ('signals', True), ('no cache', None)):
+        if signals is None:
+            manager = models.Manager()
+        else:
+            django_settings.CACHEPHOBIA_SIGNALS = signals
+            manager = CacheManager(LonerBehavior())
+        model = make_model('WriteRow' + name.title().replace(' ', ''), objects=manager)
+        create_table(model)
+        model.objects.bulk_create(make_objs(model, rows))
+        variants.append((name, model))
+    del django_settings.CACHEPHOBIA_SIGNALS
+
+    def bulk_update(model):
+        for i in range(1, rows + 1, chunk):
+            model.objects.filter(pk__in=list(range(i, i + chunk))).update(debt=i)
+
+    def save(model, objs):
+        for obj in objs:
+            obj.save()
+
+    report('bulk update by %d pks' % chunk,
+           [(name, measure(lambda: bulk_update(model), rows)) for name, model in variants])
+
+    objs = dict((name, list(model._base_manager.all()[:rows // 10])) for name, model in variants)
+    report('save',
+           [(name, measure(lambda: save(model, objs[name]), rows // 10)) for name, model in variants])
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'compression': bench_compression,
+    'serialize': bench_serialize,
+    'writes': bench_writes,
+}
+
+
+def main(names):
+    setup()
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
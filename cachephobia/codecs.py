@@ -0,0 +1,333 @@
+'''
+Codecs that turn behavior values into cache blobs and back,
+and compressors of large blobs.
+'''
+from decimal import Decimal
+from uuid import UUID
+from zlib import crc32
+import struct
+import zlib
+import six
+import ujson as json
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec(object):
+    '''
+    Base codec.
+    Args: fields = <tuple> of model attnames in stable order
+    '''
+    name = None
+
+    def __init__(self, fields=()):
+        self.fields = tuple(fields)
+
+    def dumps(self, values):
+        raise NotImplementedError
+
+    def loads(self, data):
+        '''
+        Return: decoded values or None if data was written
+                with other version/schema (treated as cache miss)
+        '''
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = 'json'
+
+    def dumps(self, values):
+        return json.dumps(values)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+# Value tags of binary format
+T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_MAP, T_ROW = range(10)
+
+_double = struct.Struct('>d')
+_header = struct.Struct('>2sBI')
+
+
+def _write_uint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_uint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+class BinaryCodec(Codec):
+    '''
+    Compact positional format.
+    Header: magic 'CP', format version, crc32 of field names.
+    Rows (dicts containing every model field) are written as values
+    in field order followed by a map of extra keys, so field names
+    are not repeated in every blob. Blobs written for another schema
+    or version are treated as misses.
+    '''
+    name = 'binary'
+    MAGIC = b'CP'
+    VERSION = 1
+
+    def __init__(self, fields=()):
+        super(BinaryCodec, self).__init__(fields)
+        self._fieldset = frozenset(self.fields)
+        schema = ','.join(self.fields).encode('utf-8')
+        self.schema_hash = crc32(schema) & 0xffffffff
+        self._prefix = _header.pack(self.MAGIC, self.VERSION, self.schema_hash)
+
+    def dumps(self, values):
+        out = bytearray(self._prefix)
+        self._write(out, values)
+        return bytes(out)
+
+    def loads(self, data):
+        data = bytearray(data)
+        if len(data) < _header.size:
+            raise CodecError('Blob is too short')
+        magic, version, schema_hash = _header.unpack_from(bytes(data[:_header.size]))
+        if magic != self.MAGIC:
+            raise CodecError('Not a binary cachephobia blob')
+        if version != self.VERSION or schema_hash != self.schema_hash:
+            return None
+        try:
+            value, pos = self._read(data, _header.size)
+        except (IndexError, struct.error):
+            raise CodecError('Blob is truncated')
+        # Slices of truncated strings do not fail, but end past data
+        if pos != len(data):
+            raise CodecError('Blob is truncated')
+        return value
+
+    def _is_row(self, value):
+        return bool(self._fieldset) and self._fieldset.issubset(value)
+
+    def _write(self, out, value):
+        if value is None:
+            out.append(T_NONE)
+        elif value is True:
+            out.append(T_TRUE)
+        elif value is False:
+            out.append(T_FALSE)
+        elif isinstance(value, six.integer_types):
+            out.append(T_INT)
+            # zigzag encoding keeps small negative numbers short
+            _write_uint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            out.append(T_FLOAT)
+            out.extend(_double.pack(value))
+        elif isinstance(value, six.text_type):
+            encoded = value.encode('utf-8')
+            out.append(T_STR)
+            _write_uint(out, len(encoded))
+            out.extend(encoded)
+        elif isinstance(value, bytes):
+            out.append(T_BYTES)
+            _write_uint(out, len(value))
+            out.extend(value)
+        elif isinstance(value, (list, tuple)):
+            out.append(T_LIST)
+            _write_uint(out, len(value))
+            for item in value:
+                self._write(out, item)
+        elif isinstance(value, dict):
+            if self._is_row(value):
+                out.append(T_ROW)
+                for field in self.fields:
+                    self._write(out, value[field])
+                extra = [(k, v) for k, v in six.iteritems(value) if k not in self._fieldset]
+                self._write_map(out, extra)
+            else:
+                out.append(T_MAP)
+                self._write_map(out, list(six.iteritems(value)))
+        elif isinstance(value, (Decimal, UUID)):
+            # Exact value as string, same as field encoders do
+            self._write(out, six.text_type(value))
+        else:
+            raise CodecError('Can not encode %r' % type(value))
+
+    def _write_map(self, out, items):
+        _write_uint(out, len(items))
+        for key, item in items:
+            self._write(out, six.text_type(key))
+            self._write(out, item)
+
+    def _read(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == T_NONE:
+            return None, pos
+        elif tag == T_TRUE:
+            return True, pos
+        elif tag == T_FALSE:
+            return False, pos
+        elif tag == T_INT:
+            value, pos = _read_uint(data, pos)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+        elif tag == T_FLOAT:
+            return _double.unpack_from(bytes(data[pos:pos + 8]))[0], pos + 8
+        elif tag == T_STR:
+            size, pos = _read_uint(data, pos)
+            return data[pos:pos + size].decode('utf-8'), pos + size
+        elif tag == T_BYTES:
+            size, pos = _read_uint(data, pos)
+            return bytes(data[pos:pos + size]), pos + size
+        elif tag == T_LIST:
+            size, pos = _read_uint(data, pos)
+            result = []
+            for i in range(size):
+                item, pos = self._read(data, pos)
+                result.append(item)
+            return result, pos
+        elif tag == T_MAP:
+            return self._read_map(data, pos, {})
+        elif tag == T_ROW:
+            result = {}
+            for field in self.fields:
+                result[field], pos = self._read(data, pos)
+            return self._read_map(data, pos, result)
+        raise CodecError('Unknown tag %d' % tag)
+
+    def _read_map(self, data, pos, result):
+        size, pos = _read_uint(data, pos)
+        for i in range(size):
+            key, pos = self._read(data, pos)
+            result[key], pos = self._read(data, pos)
+        return result, pos
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    BinaryCodec.name: BinaryCodec,
+}
+
+
+# Compressed blob: NUL byte (JSON and binary blobs never start
+# with it), compressor id and compressed data. Plain and compressed
+# blobs can be stored side by side.
+COMPRESSED = b'\x00'
+
+
+class Compressor(object):
+    id = None
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    id = b'z'
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(Compressor):
+    id = b'l'
+    name = 'lz4'
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        return lz4.decompress(data)
+
+
+COMPRESSORS = {
+    ZlibCompressor.name: ZlibCompressor,
+    LZ4Compressor.name: LZ4Compressor,
+}
+
+_decompressors = {ZlibCompressor.id: ZlibCompressor()}
+if lz4 is not None:
+    _decompressors[LZ4Compressor.id] = LZ4Compressor()
+
+
+def get_compressor(compressor):
+    '''
+    Args: compressor = <str> name from COMPRESSORS or <Compressor> instance
+    '''
+    if isinstance(compressor, six.string_types):
+        if compressor == LZ4Compressor.name and lz4 is None:
+            raise ValueError('Compression "lz4" requires lz4 package')
+        try:
+            return COMPRESSORS[compressor]()
+        except KeyError:
+            raise ValueError('Unknown compression "%s"' % compressor)
+    return compressor
+
+
+def compress(data, threshold, compressor):
+    '''
+    Return: compressed blob if data is at least 'threshold' bytes
+            (0 disables compression) and compression pays off,
+            otherwise data
+    '''
+    if not threshold or len(data) < threshold:
+        return data
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    packed = compressor.compress(data)
+    if len(packed) + 2 >= len(data):
+        return data
+    return COMPRESSED + compressor.id + packed
+
+
+def decompress(data):
+    '''
+    Return: data of compressed blob or plain blob as is
+    '''
+    if data[:1] != COMPRESSED:
+        return data
+    decompressor = _decompressors.get(data[1:2])
+    if decompressor is None:
+        raise CodecError('Unknown compressor of blob %r' % data[1:2])
+    try:
+        return decompressor.decompress(data[2:])
+    except Exception as e:
+        raise CodecError('Can not decompress blob: %s' % e)
+
+
+def get_codec(codec, fields=()):
+    '''
+    Args: codec = <str> name from CODECS or <Codec> subclass
+    Return: codec instance bound to fields
+    '''
+    if isinstance(codec, six.string_types):
+        try:
+            codec = CODECS[codec]
+        except KeyError:
+            raise ValueError('Unknown codec "%s"' % codec)
+    return codec(fields)
@@ -6,8 +6,27 @@ class Settings(object):
     CACHEPHOBIA_ENABLED = True
     CACHEPHOBIA_DEBUG = False
     CACHEPHOBIA_REDIS = {}
+    CACHEPHOBIA_REDIS_POOL = {}
+    CACHEPHOBIA_REDIS_REPLICAS = []
+    CACHEPHOBIA_REDIS_WORKERS = 8
+    CACHEPHOBIA_READ_YOUR_WRITES = 0
+    CACHEPHOBIA_SIGNALS = False
+    CACHEPHOBIA_ASYNC_WORKERS = 8
+    CACHEPHOBIA_REFRESH_WORKERS = 4
+    CACHEPHOBIA_METRICS = True
+    CACHEPHOBIA_METRICS_PUSH = 0
     CACHEPHOBIA_DEFAULTS = {
         'timeout': 60 * 60,
+        'codec': 'json',
+        'generation_ttl': 1,
+        'single_flight': False,
+        'lock_timeout': 10,
+        'lock_wait': 1,
+        'early_expiration': 0,
+        'batch_size': 1000,
+        'capture_ids': False,
+        'compress_threshold': 0,
+        'compression': 'zlib',
     }
 
     def __getattribute__(self, name):
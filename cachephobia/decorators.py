@@ -1,42 +1,227 @@
 from rest_framework.response import Response
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.http import HttpResponse, HttpResponseNotModified
+from copy import copy
 from functools import wraps
 from hashlib import md5
 from inspect import getsource
+from threading import Semaphore, Thread
+from time import time
+import six
 import ujson as json
-from .conf import settings
+from .conf import settings, logger
 from .redis import cache
+from .codecs import get_compressor, compress, decompress
+from .tags import set_with_tags, TAGGED
+from .metrics import metrics
+from .signals import post_update
+from . import hooks
+
+
+# Cached response: ENTRY, JSON of meta, newline and body.
+# Meta: 'r' = body is rendered response, 'ct' = its content type,
+#       'e' = time when entry becomes stale (with soft timeout),
+#       'h' = md5 of body (ETag).
+# Values without ENTRY are JSON of response data.
+ENTRY = b'cp1\n'
+
+
+def pack_entry(meta, body):
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    return ENTRY + json.dumps(meta).encode('utf-8') + b'\n' + body
+
+
+def unpack_entry(blob):
+    '''
+    Return: (meta, body), meta is {} for values stored as data JSON
+    '''
+    if blob[:len(ENTRY)] != ENTRY:
+        return {}, blob
+    end = blob.index(b'\n', len(ENTRY))
+    return json.loads(blob[len(ENTRY):end]), blob[end + 1:]
+
+
+def _query_factor(query):
+    if hasattr(query, 'lists'):
+        return repr(sorted(query.lists()))
+    if isinstance(query, dict):
+        return repr(sorted(query.items()))
+    return repr(query)
+
+
+def _etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+
+def _resolve_tables(models):
+    from django.apps import apps
+    tables = []
+    for model in models:
+        if isinstance(model, six.string_types):
+            model = apps.get_model(model)
+        # Writes of models without CacheManager do not invalidate tags
+        if model not in hooks._registry and not post_update.has_listeners(model):
+            raise ImproperlyConfigured(
+                'depends_on model %s.%s does not use CacheManager'
+                % (model._meta.app_label, model.__name__))
+        tables.append(model._meta.db_table)
+    return tables
+
+
+_refresh_slots = None
+
+
+def _refresh(target, *args):
+    '''
+    Run refresh in background thread, at most
+    CACHEPHOBIA_REFRESH_WORKERS at once.
+    Return: False if there is no free worker
+    '''
+    global _refresh_slots
+    if _refresh_slots is None:
+        _refresh_slots = Semaphore(settings.CACHEPHOBIA_REFRESH_WORKERS)
+    if not _refresh_slots.acquire(False):
+        return False
+
+    def run():
+        try:
+            target(*args)
+        except Exception:
+            logger.exception('[CACHEPHOBIA] <API> Refresh failed')
+        finally:
+            connections.close_all()
+            _refresh_slots.release()
+
+    thread = Thread(target=run, name='cachephobia-refresh')
+    thread.daemon = True
+    thread.start()
+    return True
 
 
 def cachephobic_api(**kwargs):
     '''
-    Cache Rest Framework APIView methods (without invalidation)
+    Cache Rest Framework APIView methods.
     Allowed only GET method.
     Cached only HTTP status code = 200.
+    Without 'depends_on' cache is not invalidated (only timeout).
+    With 'depends_on' = [<model or 'app_label.Model'>, ...] response
+    is tagged by tables of models and deleted on their save/update/
+    delete (models must use CacheManager).
+    Bodies of 'compress_threshold' bytes and more are compressed.
+    With 'rendered' response is rendered once and its bytes are
+    returned on hits as HttpResponse (without DRF rendering).
+    With 'soft_timeout' (less than 'timeout') entry older than it is
+    still served, and one process refreshes it in background: the
+    method is called again on a copy of the view with the same request
+    after response is returned, so it must be free of side effects.
+    Responses have ETag of cached body, request with matching
+    If-None-Match gets 304 without body.
     '''
 
-    timeout = kwargs.pop('timeout', settings.CACHEPHOBIA_DEFAULTS['timeout'])
+    defaults = settings.CACHEPHOBIA_DEFAULTS
+    timeout = kwargs.pop('timeout', defaults['timeout'])
     debug = kwargs.pop('debug', settings.CACHEPHOBIA_DEBUG)
     request_attr = kwargs.pop('request_attr', 'GET')
+    compress_threshold = kwargs.pop('compress_threshold', defaults.get('compress_threshold', 0))
+    compressor = get_compressor(kwargs.pop('compression', defaults.get('compression', 'zlib')))
+    rendered = kwargs.pop('rendered', False)
+    depends_on = kwargs.pop('depends_on', None)
+    soft_timeout = kwargs.pop('soft_timeout', None)
+    lock_timeout = defaults.get('lock_timeout', 10)
 
     if kwargs:
         raise TypeError('Unexpected keyword arguments %s' % ', '.join(kwargs))
 
-    def hash_api(func, instance, request, debug=False):
-        factors = [
-            func.__module__,
-            instance.__class__.__name__,
-            func.__name__,
-            request.method,
-            getattr(request, request_attr)
-        ]
-
+    def decorator(func):
+        # Factors known at decoration time are joined once
+        static = [func.__module__, func.__name__]
         if debug:
-            factors.append(getsource(func))
-            factors.append(getsource(cachephobic_api))
+            static.append(getsource(func))
+            static.append(getsource(cachephobic_api))
+        static = '\n'.join(static)
+        # Tables are resolved on the first call, when all models are loaded
+        tables = []
+        # Tagged entries are kept on one node with their tag sets
+        prefix = TAGGED + 'api:' if depends_on else 'cp:api:'
+        # Method can be inherited by several views
+        view_labels = {}
 
-        return md5(json.dumps(factors, sort_keys=True)).hexdigest()
+        def get_labels(view):
+            cls = view.__class__
+            labels = view_labels.get(cls)
+            if labels is None:
+                labels = view_labels[cls] = (
+                    'api', '%s.%s.%s' % (cls.__module__, cls.__name__, func.__name__))
+            return labels
+
+        def hash_api(instance, request):
+            factors = [
+                static,
+                instance.__class__.__name__,
+                request.method,
+                _query_factor(getattr(request, request_attr)),
+            ]
+            if rendered:
+                # Rendered bytes depend on negotiated renderer
+                factors.append(request.META.get('HTTP_ACCEPT', ''))
+            return md5('\n'.join(factors).encode('utf-8')).hexdigest()
+
+        def compute(key, view, request, args, kwargs):
+            response = func(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                if rendered:
+                    response = view.finalize_response(request, response, *args, **kwargs)
+                    response.render()
+                    meta = {'r': 1, 'ct': response['Content-Type']}
+                    body = response.content
+                else:
+                    meta = {}
+                    body = json.dumps(response.data)
+                if soft_timeout:
+                    meta['e'] = time() + soft_timeout
+                if isinstance(body, six.text_type):
+                    body = body.encode('utf-8')
+                meta['h'] = md5(body).hexdigest()
+                response['ETag'] = '"%s"' % meta['h']
+                value = compress(pack_entry(meta, body), compress_threshold, compressor)
+                if depends_on:
+                    if not tables:
+                        tables.extend(_resolve_tables(depends_on))
+                    set_with_tags(key, value, tables, timeout)
+                else:
+                    cache.set(key, value, timeout)
+            return response
+
+        def refresh(key, lock, view, request, args, kwargs):
+            try:
+                compute(key, view, request, args, kwargs)
+            finally:
+                lock.release()
+
+        def revalidate(key, view, request, args, kwargs):
+            '''
+            Start refresh of stale entry unless other process does it.
+            '''
+            lock = cache.lock('cp:lock:%s' % key, timeout=lock_timeout, thread_local=False)
+            if not lock.acquire(blocking=False):
+                return
+            # Copy keeps attributes set by method off the live view
+            if _refresh(refresh, key, lock, copy(view), request, args, kwargs):
+                metrics.incr(get_labels(view), 'refreshes')
+            else:
+                lock.release()
 
-    def decorator(func):
         @wraps(func)
         def wrapper(self, request, *args, **kwargs):
             if not settings.CACHEPHOBIA_ENABLED:
@@ -45,16 +230,34 @@ def cachephobic_api(**kwargs):
             if request.method != 'GET':
                 raise Exception('Only GET method can be cached')
 
-            key = 'cp:api:' + hash_api(func, self, request, debug=debug)
+            key = prefix + hash_api(self, request)
             cached = cache.get(key)
             if cached is not None:
-                data = json.loads(cached)
-                return Response(data, status=200)
-            else:
-                response = func(self, request, *args, **kwargs)
-                if response.status_code == 200:
-                    cache.set(key, json.dumps(response.data), timeout)
+                labels = get_labels(self)
+                meta, body = unpack_entry(decompress(cached))
+                if 'e' in meta and meta['e'] < time():
+                    metrics.incr(labels, 'stale_serves')
+                    revalidate(key, self, request, args, kwargs)
+                else:
+                    metrics.incr(labels, 'hits')
+
+                etag = '"%s"' % (meta.get('h') or md5(body).hexdigest())
+                if _etag_matches(request, etag):
+                    response = HttpResponseNotModified()
+                elif meta.get('r'):
+                    response = HttpResponse(body, content_type=meta['ct'], status=200)
+                else:
+                    response = Response(json.loads(body), status=200)
+                response['ETag'] = etag
                 return response
 
+            metrics.incr(get_labels(self), 'misses')
+            response = compute(key, self, request, args, kwargs)
+            etag = response.get('ETag') if response.status_code == 200 else None
+            if etag and _etag_matches(request, etag):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+            return response
+
         return wrapper
     return decorator
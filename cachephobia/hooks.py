@@ -0,0 +1,99 @@
+'''
+Precomputed per-model registry of cache write hooks.
+Model saves and CacheQuerySet updates/deletes call hooks directly,
+custom signals are sent only if somebody listens to them.
+With CACHEPHOBIA_SIGNALS = True managers connect to signals instead
+(the old behaviour, e.g. for code that sends 'post_save' manually).
+Instance deletes always go through 'post_delete' signal, because
+Django collector sends it for cascaded objects too.
+'''
+from django.db.models import Model
+from .signals import pure_post_delete, post_update
+
+
+class Hooks(object):
+    __slots__ = ('save', 'update', 'delete')
+
+    def __init__(self):
+        self.save = ()
+        self.update = ()
+        self.delete = ()
+
+
+EMPTY = Hooks()
+_registry = {}
+
+
+def register(model, save=None, update=None, delete=None):
+    '''
+    Add hooks of model, they are called in order of registration.
+    Args: save = callable(sender, instance, created, raw, using, update_fields),
+          update = callable(sender, queryset, **updated),
+          delete = callable(sender, queryset, count)
+    '''
+    hooks = _registry.get(model)
+    if hooks is None:
+        hooks = _registry[model] = Hooks()
+    if save is not None:
+        hooks.save += (save,)
+    if update is not None:
+        hooks.update += (update,)
+    if delete is not None:
+        hooks.delete += (delete,)
+    _patch_model()
+
+
+def get_hooks(model):
+    hooks = _registry.get(model)
+    if hooks is None:
+        # Deferred model classes of Django < 1.10
+        if getattr(model, '_deferred', False):
+            return _registry.get(model._meta.proxy_for_model, EMPTY)
+        return EMPTY
+    return hooks
+
+
+def saved(model, instance, created, raw=False, using=None, update_fields=None):
+    for hook in get_hooks(model).save:
+        hook(sender=model, instance=instance, created=created, raw=raw,
+             using=using, update_fields=update_fields)
+
+
+def updated(model, queryset, values):
+    for hook in get_hooks(model).update:
+        hook(sender=model, queryset=queryset, **values)
+    if post_update.has_listeners(model):
+        post_update.send(sender=model, queryset=queryset, **values)
+
+
+def deleted(model, queryset, count):
+    for hook in get_hooks(model).delete:
+        hook(sender=model, queryset=queryset, count=count)
+    if pure_post_delete.has_listeners(model):
+        pure_post_delete.send(sender=model, queryset=queryset, count=count)
+
+
+_save_table = None
+
+
+def _patch_model():
+    '''
+    Wrap 'Model._save_table' once to call save hooks after the row
+    of saved model is written ('created' is known only there).
+    Parent tables of multi-table inheritance are skipped.
+    '''
+    global _save_table
+    if _save_table is not None:
+        return
+    _save_table = Model._save_table
+
+    def save_table(self, raw=False, cls=None, force_insert=False,
+                   force_update=False, using=None, update_fields=None):
+        updated = _save_table(self, raw, cls, force_insert, force_update, using, update_fields)
+        origin = self.__class__
+        if origin in _registry or getattr(origin, '_deferred', False):
+            if cls is None or cls is origin._meta.concrete_model:
+                saved(origin, self, not updated, raw, using, update_fields)
+        return updated
+
+    Model._save_table = save_table
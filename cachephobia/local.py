@@ -0,0 +1,168 @@
+'''
+In-process LRU+TTL cache of decoded values in front of Redis.
+Entries are invalidated across processes through Redis pub/sub.
+'''
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time, sleep
+import os
+from .conf import logger
+
+
+class LocalCache(object):
+    '''
+    Args: size = <int> max number of entries,
+          timeout = <int/float> seconds to keep entry,
+          channel = <str> pub/sub channel for invalidation messages,
+          client = <redis client> (default is cachephobia cache)
+    '''
+
+    def __init__(self, size=1000, timeout=5, channel=None, client=None):
+        self.size = size
+        self.timeout = timeout
+        self.channel = channel
+        self._client = client
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            from .redis import cache
+            return cache
+        return self._client
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def get(self, key):
+        '''
+        Return: copy of cached values or None
+        '''
+        if self.channel is not None:
+            listener.watch(self)
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time():
+                self.misses += 1
+                return None
+            # Move to the end (most recently used)
+            self._data[key] = entry
+            self.hits += 1
+        return dict(entry[1])
+
+    def set(self, key, values):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time() + self.timeout, dict(values))
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def invalidate(self, *keys, **kwargs):
+        '''
+        Delete keys locally and publish invalidation message
+        to other processes.
+        Args: keys = cache keys, or no keys to clear everything,
+              pipe = <redis pipeline> to publish with
+        '''
+        pipe = kwargs.pop('pipe', None)
+        if keys:
+            self.delete(*keys)
+            message = '\n'.join(keys)
+        else:
+            self.clear()
+            message = '*'
+
+        if self.channel is not None:
+            (pipe or self.client).publish(self.channel, message)
+
+    def on_message(self, data):
+        if not isinstance(data, str):
+            data = data.decode('utf-8')
+        if data == '*':
+            self.clear()
+        else:
+            self.delete(*data.split('\n'))
+
+
+class Listener(object):
+    '''
+    One subscriber thread per process for all local caches
+    sharing the same client. Started lazily (and restarted after
+    fork) on the first read.
+    '''
+    retry_delay = 1
+
+    def __init__(self):
+        self._caches = {}
+        self._lock = Lock()
+        self._pid = None
+        self._pubsub = None
+
+    def watch(self, local):
+        if self._pid == os.getpid() and local.channel in self._caches:
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._caches = {}
+                self._pubsub = None
+                self._pid = os.getpid()
+            if local.channel not in self._caches:
+                self._caches[local.channel] = local
+                if self._pubsub is None:
+                    self._pubsub = local.client.pubsub(ignore_subscribe_messages=True)
+                    self._pubsub.subscribe(local.channel)
+                    thread = Thread(target=self._run, args=(self._pubsub,), name='cachephobia-local')
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    self._pubsub.subscribe(local.channel)
+
+    def _run(self, pubsub):
+        while self._pubsub is pubsub:
+            try:
+                for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    channel = message['channel']
+                    if not isinstance(channel, str):
+                        channel = channel.decode('utf-8')
+                    local = self._caches.get(channel)
+                    if local is not None:
+                        local.on_message(message['data'])
+            except Exception:
+                # Messages could be lost while disconnected
+                logger.exception('[CACHEPHOBIA] <LOCAL> Invalidation listener failed, reconnecting')
+                for local in list(self._caches.values()):
+                    local.clear()
+                sleep(self.retry_delay)
+                try:
+                    pubsub.subscribe(*list(self._caches))
+                except Exception:
+                    pass
+
+
+listener = Listener()
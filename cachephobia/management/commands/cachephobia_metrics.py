@@ -0,0 +1,70 @@
+'''
+Dump cachephobia metrics.
+Run: python manage.py cachephobia_metrics [--local] [--format text|json|prometheus] [--reset]
+'''
+from __future__ import print_function
+import json
+import six
+from django.core.management.base import BaseCommand
+from cachephobia.metrics import metrics, to_prometheus, BUCKETS
+
+
+class Command(BaseCommand):
+    help = 'Dump cachephobia hit/miss counters and latency histograms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default='text', choices=('text', 'json', 'prometheus'))
+        parser.add_argument('--local', action='store_true', default=False,
+                            help='Metrics of this process instead of Redis aggregate')
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help='Clear metrics after dump')
+
+    def handle(self, *args, **options):
+        if options['local']:
+            snapshot = metrics.snapshot()
+        else:
+            snapshot = metrics.load()
+
+        fmt = options['format']
+        if fmt == 'prometheus':
+            self.stdout.write(to_prometheus(snapshot))
+        elif fmt == 'json':
+            self.stdout.write(json.dumps({
+                'counters': dict(('|'.join(key), value) for key, value in six.iteritems(snapshot['counters'])),
+                'histograms': dict(('|'.join(key), value) for key, value in six.iteritems(snapshot['histograms'])),
+                'buckets': BUCKETS,
+            }, indent=2, sort_keys=True))
+        else:
+            self._write_text(snapshot)
+
+        if options['reset']:
+            metrics.clear()
+
+    def _write_text(self, snapshot):
+        models = {}
+        for (model, behavior, name), value in six.iteritems(snapshot['counters']):
+            models.setdefault((model, behavior), {})[name] = value
+
+        for labels in sorted(models):
+            counters = models[labels]
+            hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+            ratio = float(hits) / (hits + misses) if hits + misses else 0.0
+            self.stdout.write('%s (%s): hit ratio %.3f' % (labels[0], labels[1], ratio))
+            for name in sorted(counters):
+                self.stdout.write('  %-16s %d' % (name, counters[name]))
+
+        for (model, behavior, op), histogram in sorted(snapshot['histograms'].items()):
+            count = sum(histogram[:-1])
+            if not count:
+                continue
+            self.stdout.write('%s (%s) %s: %d calls, avg %.2f ms, p99 <= %s' % (
+                model, behavior, op, count, histogram[-1] * 1000 / count,
+                self._percentile(histogram, 0.99)))
+
+    def _percentile(self, histogram, q):
+        total = sum(histogram[:-1])
+        seen = 0
+        for bound, value in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+            seen += value
+            if seen >= total * q:
+                return bound if bound == '+Inf' else '%g ms' % (bound * 1000)
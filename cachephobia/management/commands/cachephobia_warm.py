@@ -0,0 +1,123 @@
+'''
+Fill cache of models with cachephobia behaviors.
+Run: python manage.py cachephobia_warm [app_label[.Model] ...] [--workers N] [--chunk-size N]
+'''
+from __future__ import print_function
+from threading import Lock, Thread
+from time import time
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from six.moves.queue import Queue, Empty
+
+
+def get_behaviors(labels=()):
+    '''
+    Return: [(model, behavior), ...] of models with behavior,
+            only models of 'labels' (app_label or app_label.Model)
+    '''
+    if labels:
+        models = []
+        for label in labels:
+            try:
+                if '.' in label:
+                    models.append(apps.get_model(label))
+                else:
+                    models.extend(apps.get_app_config(label).get_models())
+            except LookupError as e:
+                raise CommandError(str(e))
+    else:
+        models = apps.get_models()
+
+    result = []
+    for model in models:
+        managers = getattr(model._meta, 'managers', None)
+        if managers is None:
+            # Django < 1.10
+            managers = [manager for _, _, manager in
+                        model._meta.concrete_managers + model._meta.abstract_managers]
+        for manager in managers:
+            behavior = getattr(manager, 'cp_behavior', None)
+            # Behavior is shared with inherited managers of subclasses
+            if behavior is not None and behavior.model is model:
+                result.append((model, behavior))
+                break
+    return result
+
+
+class Command(BaseCommand):
+    help = 'Fill cache of models with cachephobia behaviors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', nargs='*', metavar='app_label[.Model]')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Models warmed in parallel')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Rows per DB fetch and cache pipeline (default is behavior batch_size)')
+
+    def handle(self, *args, **options):
+        behaviors = get_behaviors(options['labels'])
+        if not behaviors:
+            self.stdout.write('No models with cachephobia behavior')
+            return
+
+        queue = Queue()
+        for item in behaviors:
+            queue.put(item)
+
+        self._lock = Lock()
+        self._rows = 0
+        self._errors = 0
+        start = time()
+
+        threads = []
+        for i in range(max(1, min(options['workers'], len(behaviors)))):
+            thread = Thread(target=self._work, args=(queue, options['chunk_size']),
+                            name='cachephobia-warm-%d' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+                if thread.is_alive():
+                    break
+            elapsed = time() - start
+            self._write('... %d rows, %.0f rows/sec' % (self._rows, self._rows / elapsed if elapsed else 0))
+
+        elapsed = time() - start
+        self._write('Warmed %d models, %d rows in %.1fs (%.0f rows/sec)' % (
+            len(behaviors) - self._errors, self._rows, elapsed, self._rows / elapsed if elapsed else 0))
+        if self._errors:
+            raise CommandError('%d models failed' % self._errors)
+
+    def _write(self, message):
+        with self._lock:
+            self.stdout.write(message)
+
+    def _progress(self, rows):
+        with self._lock:
+            self._rows += rows
+
+    def _work(self, queue, chunk_size):
+        try:
+            while True:
+                try:
+                    model, behavior = queue.get_nowait()
+                except Empty:
+                    return
+                label = '%s.%s' % (model._meta.app_label, model.__name__)
+                start = time()
+                try:
+                    rows = behavior.warm(chunk_size=chunk_size, progress=self._progress)
+                except Exception as e:
+                    with self._lock:
+                        self._errors += 1
+                    self._write('%s (%s): failed: %r' % (label, type(behavior).__name__, e))
+                    continue
+                elapsed = time() - start
+                self._write('%s (%s): %d rows in %.1fs (%.0f rows/sec)' % (
+                    label, type(behavior).__name__, rows, elapsed, rows / elapsed if elapsed else 0))
+        finally:
+            connections.close_all()
@@ -0,0 +1,186 @@
+'''
+In-process counters and latency histograms of behaviors,
+optionally aggregated in Redis hash 'cp:metrics'.
+Labels: model = '<app_label>.<model_name>', behavior = class name.
+'''
+from collections import defaultdict
+from functools import wraps
+from threading import Lock
+from time import time
+import six
+from .conf import settings, logger
+
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+REDIS_KEY = 'cp:metrics'
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self._enabled = None
+        self._push_every = 0
+        self._pushed = time()
+        self.reset()
+
+    @property
+    def enabled(self):
+        if self._enabled is None:
+            self._enabled = settings.CACHEPHOBIA_METRICS
+            self._push_every = settings.CACHEPHOBIA_METRICS_PUSH
+        return self._enabled
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.histograms = {}
+
+    def incr(self, labels, name, value=1):
+        '''
+        Args: labels = (model, behavior),
+              name = hits, misses, local_hits, db_loads,
+                     bytes_read, bytes_written, invalidations, ...
+        '''
+        if not self.enabled or not value:
+            return
+        with self._lock:
+            self.counters[labels + (name,)] += value
+
+    def observe(self, labels, op, seconds):
+        if not self.enabled:
+            return
+        key = labels + (op,)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # bucket counts, +Inf, sum
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+        if self._push_every and self._pushed + self._push_every < time():
+            self._pushed = time()
+            try:
+                self.push()
+            except Exception:
+                logger.exception('[CACHEPHOBIA] <METRICS> Can not push metrics to Redis')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': dict((key, list(value)) for key, value in six.iteritems(self.histograms)),
+            }
+
+    def push(self, client=None):
+        '''
+        Add local values to Redis aggregate and reset them.
+        '''
+        if client is None:
+            from .redis import cache as client
+
+        with self._lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = defaultdict(int), {}
+
+        pipe = client.pipeline(transaction=False)
+        for key, value in six.iteritems(counters):
+            pipe.hincrby(REDIS_KEY, '|'.join(('c',) + key), value)
+        for key, histogram in six.iteritems(histograms):
+            field = '|'.join(('h',) + key)
+            for i, value in enumerate(histogram[:-1]):
+                if value:
+                    pipe.hincrby(REDIS_KEY, '%s|%d' % (field, i), value)
+            pipe.hincrbyfloat(REDIS_KEY, field + '|sum', histogram[-1])
+        pipe.execute()
+
+    def load(self, client=None):
+        '''
+        Return: snapshot of Redis aggregate
+        '''
+        if client is None:
+            from .redis import cache as client
+
+        counters = {}
+        histograms = {}
+        for field, value in six.iteritems(client.hgetall(REDIS_KEY)):
+            if not isinstance(field, str):
+                field = field.decode('utf-8')
+            parts = field.split('|')
+            if parts[0] == 'c':
+                counters[tuple(parts[1:])] = int(value)
+            elif parts[0] == 'h':
+                key = tuple(parts[1:4])
+                histogram = histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+                if parts[4] == 'sum':
+                    histogram[-1] = float(value)
+                else:
+                    histogram[int(parts[4])] = int(value)
+        return {'counters': counters, 'histograms': histograms}
+
+    def clear(self, client=None):
+        if client is None:
+            from .redis import cache as client
+        self.reset()
+        client.delete(REDIS_KEY)
+
+
+def to_prometheus(snapshot):
+    '''
+    Return: snapshot in Prometheus text exposition format
+    '''
+    lines = ['# TYPE cachephobia_events_total counter']
+    for (model, behavior, name), value in sorted(snapshot['counters'].items()):
+        lines.append('cachephobia_events_total{model="%s",behavior="%s",event="%s"} %d'
+                     % (model, behavior, name, value))
+
+    lines.append('# TYPE cachephobia_latency_seconds histogram')
+    for (model, behavior, op), histogram in sorted(snapshot['histograms'].items()):
+        labels = 'model="%s",behavior="%s",op="%s"' % (model, behavior, op)
+        total = 0
+        for bound, value in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+            total += value
+            lines.append('cachephobia_latency_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+        lines.append('cachephobia_latency_seconds_sum{%s} %f' % (labels, histogram[-1]))
+        lines.append('cachephobia_latency_seconds_count{%s} %d' % (labels, total))
+    return '\n'.join(lines) + '\n'
+
+
+def timed(op):
+    '''
+    Observe latency of behavior method as 'op'.
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.observe(self._labels, op, time() - start)
+        return wrapper
+    return decorator
+
+
+def prometheus_view(request):
+    '''
+    Django view with metrics of current process
+    (or Redis aggregate with '?source=redis').
+    '''
+    from django.http import HttpResponse
+    if request.GET.get('source') == 'redis':
+        snapshot = metrics.load()
+    else:
+        snapshot = metrics.snapshot()
+    return HttpResponse(to_prometheus(snapshot), content_type='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
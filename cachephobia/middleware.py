@@ -0,0 +1,23 @@
+'''
+Middleware of cachephobia.
+'''
+from .redis import read_your_writes
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+
+class ReadYourWritesMiddleware(MiddlewareMixin):
+    '''
+    Read-your-writes window of replica routing is started by
+    cache writes of current request only.
+    '''
+
+    def process_request(self, request):
+        read_your_writes.reset()
+
+    def process_response(self, request, response):
+        read_your_writes.reset()
+        return response
@@ -1,4 +1,5 @@
 from django.db.models.sql import OR
+from django.db.models.sql.where import WhereNode
 from django.db.models.lookups import Lookup, Exact, In, IsNull
 
 
@@ -19,6 +20,64 @@ def get_qs_ids(queryset, only=False):
     return value
 
 
+def get_cacheable_ids(queryset, where):
+    '''
+    Return: list of pks if queryset filters only by pk (exact or in)
+            and by all exact conditions of behavior 'where',
+            otherwise None
+    '''
+    opts = queryset.model._meta
+    required = {}
+    for lookup, value in where.items():
+        if '__' in lookup:
+            return None
+        required[opts.get_field(lookup).attname] = value
+
+    pkname = opts.pk.attname
+    ids = None
+    matched = set()
+    for child in _flatten(queryset.query.where):
+        if child is None or not isinstance(child, (Exact, In)):
+            return None
+        target = getattr(child.lhs, 'target', None)
+        if target is None or hasattr(child.rhs, 'resolve_expression'):
+            return None
+
+        attname = target.attname
+        if attname == pkname and ids is None:
+            if isinstance(child, In):
+                if not isinstance(child.rhs, (list, tuple, set)):
+                    return None
+                ids = list(child.rhs)
+            else:
+                ids = [child.rhs]
+        elif isinstance(child, Exact) and attname in required and required[attname] == child.rhs:
+            matched.add(attname)
+        else:
+            return None
+
+    if ids is None or len(matched) != len(required):
+        return None
+    return ids
+
+
+def _flatten(where):
+    '''
+    Yield lookups of AND-only not negated tree,
+    None for nodes of other kind (e.g. NothingNode of .none()).
+    '''
+    if isinstance(where, Lookup):
+        yield where
+    elif not isinstance(where, WhereNode):
+        yield None
+    elif where.negated or (where.connector == OR and len(where.children) > 1):
+        yield None
+    else:
+        for child in where.children:
+            for lookup in _flatten(child):
+                yield lookup
+
+
 def _find(where, what, lookups=(Exact,), negate=False, op_or=False,
           extra=None):
 
@@ -28,7 +87,7 @@ def _find(where, what, lookups=(Exact,), negate=False, op_or=False,
             if attname == what:
                 extra['lookup'] = where
                 return where.rhs, extra
-    else:
+    elif isinstance(where, WhereNode):
         if where.negated and not negate:
             return None, None
 
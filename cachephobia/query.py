@@ -1,13 +1,28 @@
+from django.db import connections, transaction
 from django.db.models import sql
 from django.db.models.query import QuerySet
 from django.db.models.manager import Manager
 from django.db.models.signals import post_save, post_delete
 from django.utils.functional import cached_property
 from .signals import pure_post_delete, post_update, cache_read
-from .conf import settings
-from .parser import get_qs_ids
+from . import hooks
+from .conf import settings, logger
+from .codecs import CodecError
+from .parser import get_qs_ids, get_cacheable_ids
+from .transaction import get_batch
+from .tags import set_with_tags, invalidate_tables, track, is_tracked, TAGGED
+from .redis import cache
+from .metrics import metrics
+from hashlib import md5
+from time import time
+from six.moves import cPickle as pickle
 from funcy import once_per
 import sys
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
 
 
 def connect_first(signal, receiver, sender):
@@ -23,17 +38,125 @@ def model_is_fake(model):
 
 class CacheQuerySet(QuerySet):
     cp_behavior = None
+    cp_timeout = None
 
     def _fetch_all(self):
+        # Cache writes of transaction are deferred till commit,
+        # so inside of it cache may miss its own changes
+        if self._result_cache is None and connections[self.db].in_atomic_block:
+            cache_read.send(sender=self.model, hit=False)
+            super(CacheQuerySet, self)._fetch_all()
+            return
+
+        if self._result_cache is None and self.cp_timeout is not None:
+            self._fetch_tagged()
+            return
+
+        if self._result_cache is None and self.cp_behavior is not None:
+            ids = self._cacheable_ids()
+            if ids is not None:
+                self._result_cache = self._fetch_cached(ids)
+                if self._prefetch_related_lookups and not self._prefetch_done:
+                    self._prefetch_related_objects()
+                cache_read.send(sender=self.model, hit=True)
+                return
+
+        cache_read.send(sender=self.model, hit=False)
+        super(CacheQuerySet, self)._fetch_all()
+
+    def _fetch_tagged(self):
+        '''
+        Serve queryset result by key of its SQL, entry is tagged
+        by all tables in query and deleted on write to any of them.
+        Tables of subqueries are not tracked.
+        Querysets with tables of models without CacheManager or
+        with prefetch_related are not cached (their writes are
+        not seen).
+        '''
+        query = self.query.clone()
+        try:
+            sql_, params = query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            # E.g. filter(pk__in=[]), Django does not query DB too
+            self._result_cache = []
+            return
+        # Joins are known after compilation
+        tables = set(join.table_name for join in query.alias_map.values())
+        if self._prefetch_related_lookups or not is_tracked(tables):
+            cache_read.send(sender=self.model, hit=False)
+            super(CacheQuerySet, self)._fetch_all()
+            return
+        factors = [
+            self.db,
+            ' '.join(sql_.split()),
+            repr(params),
+            type(self).__name__,
+            getattr(getattr(self, '_iterable_class', None), '__name__', ''),
+            repr(self._fields),
+            repr(getattr(self, 'flat', None)),
+        ]
+        key = TAGGED + 'qs:' + md5('\n'.join(factors).encode('utf-8')).hexdigest()
+
+        cached = cache.get(key)
+        if cached is not None:
+            self._result_cache = pickle.loads(cached)
+            cache_read.send(sender=self.model, hit=True)
+            return
+
         cache_read.send(sender=self.model, hit=False)
         super(CacheQuerySet, self)._fetch_all()
+        set_with_tags(key, pickle.dumps(self._result_cache, -1), tables, self.cp_timeout)
+
+    def _cacheable_ids(self):
+        '''
+        Return: pks if queryset can be served by behavior
+                (only pk and behavior 'where' filters, plain
+                model instances of all fields), otherwise None
+        '''
+        query = self.query
+        if (self._fields is not None or self._db is not None
+                or query.select_related or query.select_for_update
+                or query.distinct or query.extra or query.annotations
+                or query.deferred_loading != (set(), True)
+                or len(query.alias_map) > 1
+                or getattr(query, 'combinator', None) or query.is_empty()):
+            return None
+
+        ids = get_cacheable_ids(self, self.cp_behavior.where)
+        if ids is not None and len(ids) > 1 and self.ordered:
+            return None
+        return ids
+
+    def _fetch_cached(self, ids):
+        seen = set()
+        ids = [pk for pk in ids if not (pk in seen or seen.add(pk))]
+        values = self.cp_behavior.get_many(ids)
+
+        result = []
+        for pk in ids:
+            if values.get(pk) is not None:
+                result.append(self.cp_behavior._values_to_instance(values[pk], self.db))
+        return result[self.query.low_mark:self.query.high_mark]
+
+    def cached(self, timeout=None):
+        '''
+        Cache result of queryset by its SQL and params,
+        invalidated on save/update/delete of models in query.
+        '''
+        if not settings.CACHEPHOBIA_ENABLED:
+            return self
+        clone = self._clone()
+        if timeout is None:
+            timeout = settings.CACHEPHOBIA_DEFAULTS['timeout']
+        clone.cp_timeout = timeout
+        return clone
 
     def delete(self):
         '''
         Replaced to simple '_raw_delete' method to prevent
         extra 'SELECT' on delete if there are listeners of
-        'post_delete' signal. Send custom 'pure_post_delete'
-        signal to avoid conflicts.
+        'post_delete' signal. Call delete hooks (and custom
+        'pure_post_delete' signal) to avoid conflicts.
         '''
         assert self.query.can_filter(), \
             "Cannot use 'limit' or 'offset' with delete."
@@ -41,23 +164,29 @@ class CacheQuerySet(QuerySet):
         if self._fields is not None:
             raise TypeError("Cannot call delete() after .values() or .values_list()")
 
+        if self._capture_needed():
+            return self._captured(self._capture_delete)
+
         count = sql.DeleteQuery(self.model).delete_qs(self, self.db)
-        if count > 0 and self.cp_behavior is not None:
-            pure_post_delete.send(sender=self.model, queryset=self, count=count)
+        if count > 0 and settings.CACHEPHOBIA_ENABLED:
+            hooks.deleted(self.model, self, count)
 
         self._result_cache = None
         return count
 
     def update(self, **kwargs):
+        if self._capture_needed():
+            return self._captured(self._capture_update, **kwargs)
+
         count = super(CacheQuerySet, self).update(**kwargs)
-        if count > 0:
-            if self.cp_behavior is not None:
-                post_update.send(sender=self.model, queryset=self, **kwargs)
+        if count > 0 and settings.CACHEPHOBIA_ENABLED:
+            hooks.updated(self.model, self, kwargs)
         return count
 
     def _clone(self, **kwargs):
         clone = super(CacheQuerySet, self)._clone(**kwargs)
         clone.cp_behavior = self.cp_behavior
+        clone.cp_timeout = self.cp_timeout
         return clone
 
     def nocache(self):
@@ -68,6 +197,84 @@ class CacheQuerySet(QuerySet):
     def cp_ids(self):
         return get_qs_ids(self)
 
+    # Capture mode: when IDs can not be parsed from queryset,
+    # pks of changed rows are collected in the same transaction
+    # (RETURNING on PostgreSQL, otherwise SELECT ... FOR UPDATE)
+    # to invalidate exactly these objects.
+
+    def _capture_needed(self):
+        return (self.cp_behavior is not None
+                and self.cp_behavior.capture_ids
+                and self.cp_ids is None)
+
+    def _captured(self, method, **kwargs):
+        assert self.query.can_filter(), \
+            "Cannot update/delete a query once a slice has been taken."
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            count = None
+            if connections[self.db].vendor == 'postgresql':
+                count = method(**kwargs)
+            if count is None:
+                ids = list(self.select_for_update().values_list('pk', flat=True))
+                qs = self.filter(pk__in=ids)
+                qs.__dict__['cp_ids'] = ids
+                if kwargs:
+                    count = qs.update(**kwargs) if ids else 0
+                else:
+                    count = qs.delete() if ids else 0
+
+        self._result_cache = None
+        return count
+
+    def _returning(self, query):
+        '''
+        Execute UPDATE/DELETE query with RETURNING of pk.
+        Return: queryset with captured IDs
+        '''
+        connection = connections[self.db]
+        try:
+            sql_, params = query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            # E.g. filter(pk__in=[]), Django does not query DB too
+            sql_, params = '', ()
+        ids = []
+        if sql_:
+            pk = connection.ops.quote_name(self.model._meta.pk.column)
+            with connection.cursor() as cursor:
+                cursor.execute('%s RETURNING %s' % (sql_, pk), params)
+                ids = [row[0] for row in cursor.fetchall()]
+
+        qs = self._clone()
+        qs.__dict__['cp_ids'] = ids
+        return qs
+
+    def _capture_update(self, **kwargs):
+        query = self.query.clone(sql.UpdateQuery)
+        query.add_update_values(kwargs)
+        if query.related_updates:
+            return None
+        if not query.values:
+            # Same as UpdateQuery, nothing to update
+            return 0
+
+        qs = self._returning(query)
+        count = len(qs.cp_ids)
+        if count > 0:
+            hooks.updated(self.model, qs, kwargs)
+        return count
+
+    def _capture_delete(self):
+        query = self.query.clone(sql.DeleteQuery)
+        if len([a for a in query.alias_map if query.alias_refcount[a]]) > 1:
+            return None
+
+        qs = self._returning(query)
+        count = len(qs.cp_ids)
+        if count > 0:
+            hooks.deleted(self.model, qs, count)
+        return count
+
 
 class CacheManager(Manager):
     cp_behavior = None
@@ -81,14 +288,23 @@ class CacheManager(Manager):
     def _install_cachephobia(self, cls):
         if self.cp_behavior is not None:
             self.cp_behavior.contribute_to_class(cls)
-            connect_first(post_save, self._post_save, sender=cls)
-            connect_first(post_update, self._post_update, sender=cls)
 
-            # For Model.objects.filter(**kwargs).delete()
-            connect_first(pure_post_delete, self._pure_post_delete, sender=cls)
+        # Hooks are needed without behavior too,
+        # to invalidate cached querysets
+        if settings.CACHEPHOBIA_ENABLED:
+            if settings.CACHEPHOBIA_SIGNALS:
+                connect_first(post_save, self._post_save, sender=cls)
+                connect_first(post_update, self._post_update, sender=cls)
+
+                # For Model.objects.filter(**kwargs).delete()
+                connect_first(pure_post_delete, self._pure_post_delete, sender=cls)
+            else:
+                hooks.register(cls, save=self._post_save, update=self._post_update,
+                               delete=self._pure_post_delete)
 
             # For instance.delete()
             connect_first(post_delete, self._post_delete, sender=cls)
+            track(cls._meta.db_table)
 
             # Install auto-created models as their module
             # attributes to make them picklable
@@ -106,21 +322,42 @@ class CacheManager(Manager):
         qs.cp_behavior = self.cp_behavior
         return qs
 
-    def _post_save(self, sender, instance, **kwargs):
+    # Inside transaction cache writes are collected in Batch
+    # and sent on commit, otherwise in one pipeline at once.
+
+    def _write(self, using, method, **kwargs):
+        start = time()
+        batch = get_batch(using)
+        pipe = batch if batch is not None else cache.pipeline(transaction=False)
         if self.cp_behavior is not None:
-            self.cp_behavior.on_save(instance, **kwargs)
+            self.cp_behavior.refresh_generation()
+            getattr(self.cp_behavior, method)(pipe=pipe, **kwargs)
+        invalidate_tables([self.model._meta.db_table], client=pipe)
+        if batch is None:
+            pipe.execute()
 
-    def _post_delete(self, sender, instance=None, **kwargs):
         if self.cp_behavior is not None:
-            self.cp_behavior.on_delete(instance=instance, **kwargs)
+            labels = self.cp_behavior._labels
+            metrics.incr(labels, 'invalidations')
+            metrics.observe(labels, 'set' if method == 'on_save' else 'invalidate', time() - start)
+
+    def _post_save(self, sender, instance, **kwargs):
+        using = kwargs.pop('using', None)
+        try:
+            self._write(using, 'on_save', instance=instance, **kwargs)
+        except CodecError:
+            # Cache must not abort DB write, cached value is dropped
+            logger.exception('[CACHEPHOBIA] <SAVE> Cache of %s can not be set', instance)
+            self._write(using, 'on_delete', instance=instance)
+
+    def _post_delete(self, sender, instance=None, **kwargs):
+        self._write(kwargs.pop('using', None), 'on_delete', instance=instance, **kwargs)
 
     def _pure_post_delete(self, sender, queryset=None, count=None, **kwargs):
-        if self.cp_behavior is not None:
-            self.cp_behavior.on_delete(queryset=queryset, count=count, **kwargs)
+        self._write(queryset.db, 'on_delete', queryset=queryset, count=count, **kwargs)
 
-    def _post_update(self, sender, queryset, signal, **updated):
-        if self.cp_behavior is not None:
-            self.cp_behavior.on_update(queryset=queryset, **updated)
+    def _post_update(self, sender, queryset, signal=None, **updated):
+        self._write(queryset.db, 'on_update', queryset=queryset, **updated)
 
     def nocache(self):
         return self.get_queryset().nocache()
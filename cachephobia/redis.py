@@ -1,15 +1,564 @@
+'''
+Redis client of cachephobia.
+CACHEPHOBIA_REDIS is a URL or StrictRedis kwargs of one node,
+or a list of them to spread keys over nodes by consistent hashing.
+Keys with hash tag ('a:{tag}:b') are placed by tag only, so keys
+used together by Lua scripts can be kept on one node.
+CACHEPHOBIA_REDIS_POOL is ConnectionPool kwargs for every node
+(max_connections, socket_timeout, socket_connect_timeout, ...).
+Reads can be sent to replicas: CACHEPHOBIA_REDIS_REPLICAS (list of
+URLs/kwargs) for one node, or 'replicas' in kwargs of sharded nodes.
+After a write reads go to primary for CACHEPHOBIA_READ_YOUR_WRITES
+seconds in current thread (or until reset by the middleware).
+Per-node commands of sharded client run in parallel in a pool of
+CACHEPHOBIA_REDIS_WORKERS threads shared by the process.
+'''
 from __future__ import absolute_import
+from bisect import bisect
+from binascii import crc32
+from itertools import chain
+from random import choice
+from os import getpid
+from threading import Event, Lock, Thread, local
+from time import time
 import six
+from six.moves.queue import Queue
 import redis
 from .conf import settings
 
 
+def make_node(config, pool=None):
+    '''
+    Args: config = URL or StrictRedis kwargs,
+          pool = extra ConnectionPool kwargs
+    '''
+    pool = dict(pool or {})
+    replicas = None
+    if isinstance(config, six.string_types):
+        connection_pool = redis.ConnectionPool.from_url(config, **pool)
+    else:
+        config = dict(config)
+        config.pop('name', None)
+        replicas = config.pop('replicas', None)
+        pool.update(config)
+        connection_pool = redis.ConnectionPool(**pool)
+    client = redis.StrictRedis(connection_pool=connection_pool)
+    if replicas:
+        client = ReplicatedRedis(client, [make_node(replica, pool) for replica in replicas])
+    return client
+
+
+def node_name(config):
+    if isinstance(config, six.string_types):
+        return config
+    if 'name' in config:
+        return config['name']
+    return '%s:%s/%s' % (config.get('host', 'localhost'), config.get('port', 6379), config.get('db', 0))
+
+
+def make_client(config=None, pool=None):
+    '''
+    Return: StrictRedis for one node or ShardedRedis for list of nodes
+    '''
+    if config is None:
+        config = settings.CACHEPHOBIA_REDIS
+    if pool is None:
+        pool = settings.CACHEPHOBIA_REDIS_POOL
+    if isinstance(config, (list, tuple)):
+        return ShardedRedis([make_node(node, pool) for node in config],
+                            names=[node_name(node) for node in config])
+    client = make_node(config, pool)
+    replicas = settings.CACHEPHOBIA_REDIS_REPLICAS
+    if replicas:
+        client = ReplicatedRedis(client, [make_node(replica, pool) for replica in replicas])
+    return client
+
+
+def _to_bytes(key):
+    if isinstance(key, six.text_type):
+        return key.encode('utf-8')
+    return key
+
+
+def hash_slot(key):
+    key = _to_bytes(key)
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc32(key) & 0xffffffff
+
+
+class _Job(object):
+    '''
+    Call of run_parallel, run once by a worker or by the caller.
+    '''
+    __slots__ = ('func', 'result', 'error', 'claimed', 'done')
+
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.error = None
+        self.claimed = Lock()
+        self.done = Event()
+
+    def run(self):
+        if not self.claimed.acquire(False):
+            return
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+_jobs = None
+_jobs_pid = None
+_jobs_lock = Lock()
+
+
+def _get_jobs():
+    '''
+    Return: queue of worker threads, started once per process
+            (threads do not survive fork)
+    '''
+    global _jobs, _jobs_pid
+    pid = getpid()
+    if _jobs_pid != pid:
+        with _jobs_lock:
+            if _jobs_pid != pid:
+                _jobs = Queue()
+                for i in range(settings.CACHEPHOBIA_REDIS_WORKERS):
+                    thread = Thread(target=_work, args=(_jobs,), name='cachephobia-redis-%d' % i)
+                    thread.daemon = True
+                    thread.start()
+                _jobs_pid = pid
+    return _jobs
+
+
+def _work(jobs):
+    while True:
+        jobs.get().run()
+
+
+def run_parallel(funcs):
+    '''
+    Call functions in worker threads (the first one in current thread).
+    Caller runs functions not yet taken by busy workers itself,
+    so calls never wait for a free worker.
+    Return: list of results, the first exception is raised
+    '''
+    jobs = [_Job(func) for func in funcs]
+    if len(jobs) > 1 and settings.CACHEPHOBIA_REDIS_WORKERS > 0:
+        queue = _get_jobs()
+        for job in jobs[1:]:
+            queue.put(job)
+    for job in jobs:
+        job.run()
+    for job in jobs:
+        job.done.wait()
+    for job in jobs:
+        if job.error is not None:
+            raise job.error
+    return [job.result for job in jobs]
+
+
+class ShardedRedis(object):
+    '''
+    Client that routes commands to nodes by key (first argument).
+    Multi-key DELETE/EXISTS/MGET are split by node and run in parallel,
+    pipelines are split into per-node pipelines executed in parallel.
+    Pub/sub goes to the first node.
+    Args: nodes = redis clients (any objects with StrictRedis API),
+          names = node names for hash ring (default is indexes),
+          replicas = points of every node on hash ring
+    '''
+    sharded = True
+    SUM = frozenset(('delete', 'exists', 'unlink', 'touch'))
+
+    def __init__(self, nodes, names=None, replicas=160):
+        self.nodes = list(nodes)
+        if names is None:
+            names = [str(i) for i in range(len(self.nodes))]
+        ring = []
+        for index, name in enumerate(names):
+            for i in range(replicas):
+                ring.append((hash_slot('%s-%d' % (name, i)), index))
+        ring.sort()
+        self._points = [point for point, index in ring]
+        self._indexes = [index for point, index in ring]
+
+    def get_index(self, key):
+        i = bisect(self._points, hash_slot(key))
+        return self._indexes[i % len(self._indexes)]
+
+    def get_node(self, key):
+        return self.nodes[self.get_index(key)]
+
+    def group(self, keys):
+        '''
+        Return: {node index: [(position, key), ...]}
+        '''
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.get_index(key), []).append((position, key))
+        return groups
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return getattr(self.get_node(args[0]), name)(*args, **kwargs)
+        return command
+
+    def _multi(self, name, *args):
+        pipe = self.pipeline(transaction=False)
+        getattr(pipe, name)(*args)
+        return pipe.execute()[0]
+
+    def delete(self, *keys):
+        return self._multi('delete', *keys)
+
+    def exists(self, *keys):
+        return self._multi('exists', *keys)
+
+    def mget(self, keys, *args):
+        return self._multi('mget', keys, *args)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def lock(self, name, *args, **kwargs):
+        return self.get_node(name).lock(name, *args, **kwargs)
+
+    def publish(self, channel, message):
+        return self.nodes[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.nodes[0].pubsub(**kwargs)
+
+    def scan_iter(self, *args, **kwargs):
+        return chain.from_iterable(node.scan_iter(*args, **kwargs) for node in self.nodes)
+
+
+class ShardedPipeline(object):
+    '''
+    Commands are buffered in per-node pipelines, results
+    are returned in order of commands.
+    '''
+
+    def __init__(self, client, transaction=False):
+        self.client = client
+        self.transaction = transaction
+        self.pipes = {}
+        self.commands = []
+
+    def _pipe(self, index):
+        pipe = self.pipes.get(index)
+        if pipe is None:
+            pipe = self.pipes[index] = self.client.nodes[index].pipeline(transaction=self.transaction)
+        return pipe
+
+    def _add(self, index, name, *args, **kwargs):
+        '''
+        Return: position of command result in node pipeline
+        '''
+        pipe = self._pipe(index)
+        position = len(pipe.command_stack)
+        getattr(pipe, name)(*args, **kwargs)
+        return position
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name in ShardedRedis.SUM:
+                parts = [(index, self._add(index, name, *[key for _, key in group]), None)
+                         for index, group in six.iteritems(self.client.group(args))]
+                self.commands.append(('sum', parts))
+            elif name == 'publish':
+                self.commands.append(('first', [(0, self._add(0, name, *args), None)]))
+            else:
+                index = self.client.get_index(args[0])
+                self.commands.append(('first', [(index, self._add(index, name, *args, **kwargs), None)]))
+            return self
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        parts = []
+        for index, group in six.iteritems(self.client.group(keys)):
+            positions = [position for position, _ in group]
+            parts.append((index, self._add(index, 'mget', [key for _, key in group]), positions))
+        self.commands.append(('mget', parts))
+        return self
+
+    def script(self, script, keys, args):
+        '''
+        Call ShardedScript in pipeline.
+        '''
+        parts = []
+        for index, node_keys in script.split(keys):
+            pipe = self._pipe(index)
+            position = len(pipe.command_stack)
+            script.scripts[index](keys=node_keys, args=args, client=pipe)
+            parts.append((index, position, None))
+        self.commands.append(('sum' if len(parts) > 1 else 'first', parts))
+        return self
+
+    def execute(self):
+        indexes = list(self.pipes)
+        results = dict(zip(indexes, run_parallel([self.pipes[index].execute for index in indexes])))
+        self.pipes = {}
+        commands, self.commands = self.commands, []
+
+        output = []
+        for kind, parts in commands:
+            if kind == 'first':
+                index, position, _ = parts[0]
+                output.append(results[index][position])
+            elif kind == 'sum':
+                output.append(sum(results[index][position] for index, position, _ in parts))
+            else:
+                values = [None] * sum(len(positions) for _, _, positions in parts)
+                for index, position, positions in parts:
+                    for i, value in zip(positions, results[index][position]):
+                        values[i] = value
+                output.append(values)
+        return output
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pipes = {}
+        self.commands = []
+
+
+class ShardedScript(object):
+    '''
+    Script registered on every node, called on node of its keys.
+    Scripts marked as 'split' work on every key independently,
+    their keys may be on different nodes (results are summed).
+    '''
+
+    def __init__(self, client, source):
+        self.client = client
+        self.source = source
+        self.scripts = [node.register_script(source) for node in client.nodes]
+        self.split_keys = False
+
+    def configure(self, split=False, readonly=False):
+        self.split_keys = split
+        for script in self.scripts:
+            if hasattr(script, 'configure'):
+                script.configure(split=split, readonly=readonly)
+
+    def split(self, keys):
+        '''
+        Return: [(node index, keys), ...]
+        '''
+        if not keys:
+            return [(0, keys)]
+        groups = self.client.group(keys)
+        if len(groups) > 1 and not self.split_keys:
+            raise redis.RedisError('Keys of script are on different nodes, use hash tags: %r' % (keys,))
+        return [(index, [key for _, key in group]) for index, group in six.iteritems(groups)]
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, ShardedPipeline):
+            return client.script(self, keys, args)
+
+        parts = self.split(keys)
+        results = run_parallel([lambda index=index, node_keys=node_keys:
+                                self.scripts[index](keys=node_keys, args=args)
+                                for index, node_keys in parts])
+        return results[0] if len(results) == 1 else sum(results)
+
+
+class ReadYourWrites(local):
+    '''
+    Window of current thread after write, when reads go to primary.
+    '''
+    until = 0
+
+    def wrote(self):
+        window = settings.CACHEPHOBIA_READ_YOUR_WRITES
+        if window:
+            self.until = time() + window
+
+    def active(self):
+        return self.until > time()
+
+    def reset(self):
+        self.until = 0
+
+
+read_your_writes = ReadYourWrites()
+
+
+class ReplicatedRedis(object):
+    '''
+    Client that sends read commands to random replica
+    (unless read-your-writes window is active) and other
+    commands to primary. Pipelines go to replica only
+    if all their commands are reads. Only write commands
+    start read-your-writes window.
+    Args: primary = redis client,
+          replicas = redis clients
+    '''
+    # EXISTS is left out, it checks locks set on primary
+    READS = frozenset(('get', 'mget', 'hget', 'hgetall', 'hmget', 'smembers',
+                       'sismember', 'scard', 'pttl', 'ttl', 'strlen'))
+    WRITES = frozenset(('set', 'setex', 'psetex', 'setnx', 'mset', 'getset', 'append',
+                        'delete', 'unlink', 'incr', 'incrby', 'decr', 'decrby',
+                        'expire', 'pexpire', 'expireat', 'persist', 'rename',
+                        'hset', 'hmset', 'hsetnx', 'hdel', 'hincrby',
+                        'sadd', 'srem', 'sunionstore', 'lpush', 'rpush', 'lrem',
+                        'zadd', 'zrem', 'eval', 'evalsha', 'flushdb', 'flushall'))
+    sharded = False
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = list(replicas)
+
+    def replica_index(self):
+        '''
+        Return: index of replica to read from or None for primary
+        '''
+        if not self.replicas or read_your_writes.active():
+            return None
+        return choice(range(len(self.replicas)))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.READS:
+            index = self.replica_index()
+            if index is not None:
+                return getattr(self.replicas[index], name)
+        elif name in self.WRITES:
+            read_your_writes.wrote()
+        return getattr(self.primary, name)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ReplicatedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ReplicatedScript(self, script)
+
+    def lock(self, name, *args, **kwargs):
+        return self.primary.lock(name, *args, **kwargs)
+
+    def pubsub(self, **kwargs):
+        return self.primary.pubsub(**kwargs)
+
+    def scan_iter(self, *args, **kwargs):
+        return self.primary.scan_iter(*args, **kwargs)
+
+
+class ReplicatedPipeline(object):
+    '''
+    Commands are recorded and sent on execute to replica
+    if all of them are reads, otherwise to primary.
+    '''
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.command_stack = []
+        self.readonly = True
+        self.writes = False
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name not in ReplicatedRedis.READS:
+                self.readonly = False
+            if name in ReplicatedRedis.WRITES:
+                self.writes = True
+            self.command_stack.append((name, args, kwargs))
+            return self
+        return command
+
+    def script(self, script, keys, args):
+        if not script.readonly:
+            self.readonly = False
+            self.writes = True
+        self.command_stack.append((script, keys, args))
+        return self
+
+    def execute(self):
+        commands, self.command_stack = self.command_stack, []
+        index = self.client.replica_index() if self.readonly else None
+        if index is None:
+            if self.writes:
+                read_your_writes.wrote()
+            pipe = self.client.primary.pipeline(transaction=self.transaction)
+        else:
+            pipe = self.client.replicas[index].pipeline(transaction=False)
+        self.readonly = True
+        self.writes = False
+
+        for name, args, kwargs in commands:
+            if isinstance(name, ReplicatedScript):
+                name.get(index)(keys=args, args=kwargs, client=pipe)
+            else:
+                getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.command_stack = []
+        self.readonly = True
+        self.writes = False
+
+
+class ReplicatedScript(object):
+    '''
+    Script registered on primary and replicas, 'readonly'
+    scripts are called on replica.
+    '''
+
+    def __init__(self, client, source):
+        self.client = client
+        self.source = source
+        self.primary = client.primary.register_script(source)
+        self.replicas = [replica.register_script(source) for replica in client.replicas]
+        self.readonly = False
+
+    def configure(self, split=False, readonly=False):
+        self.readonly = readonly
+
+    def get(self, index):
+        return self.primary if index is None else self.replicas[index]
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, ReplicatedPipeline):
+            return client.script(self, keys, args)
+        if client is not None:
+            return self.primary(keys=keys, args=args, client=client)
+        if self.readonly:
+            return self.get(self.client.replica_index())(keys=keys, args=args)
+        read_your_writes.wrote()
+        return self.primary(keys=keys, args=args)
+
+
 class LazyRedis(object):
     def _setup(self):
-        if isinstance(settings.CACHEPHOBIA_REDIS, six.string_types):
-            client = redis.StrictRedis.from_url(settings.CACHEPHOBIA_REDIS)
-        else:
-            client = redis.StrictRedis(**settings.CACHEPHOBIA_REDIS)
+        client = make_client()
 
         object.__setattr__(self, '__class__', client.__class__)
         object.__setattr__(self, '__dict__', client.__dict__)
@@ -24,3 +573,14 @@ class LazyRedis(object):
 
 
 cache = LazyRedis()
+
+
+def get_primary(key):
+    '''
+    Return: client of primary of node that keeps 'key',
+            for reads that must not lag behind writes
+    '''
+    client = cache
+    if getattr(client, 'sharded', False):
+        client = client.get_node(key)
+    return getattr(client, 'primary', client)
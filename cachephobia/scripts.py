@@ -0,0 +1,166 @@
+'''
+Lua scripts executed on Redis side.
+'''
+from .redis import cache, ShardedScript, ReplicatedScript
+from .transaction import Batch
+
+
+class LazyScript(object):
+    '''
+    Registers script on the first call.
+    Call: script(keys=[...], args=[...], client=<redis client or pipeline>)
+    With 'split' script handles every key independently, so with
+    sharded client it is called per node (numeric results are summed).
+    With 'readonly' script can be called on replica.
+    '''
+
+    def __init__(self, source, split=False, readonly=False):
+        self.source = source
+        self.split = split
+        self.readonly = readonly
+        self._script = None
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, Batch):
+            return client.script(self, keys, args)
+        if self._script is None:
+            self._script = cache.register_script(self.source)
+            if isinstance(self._script, (ShardedScript, ReplicatedScript)):
+                self._script.configure(split=self.split, readonly=self.readonly)
+        return self._script(keys=keys, args=args, client=client)
+
+
+# Set hash fields only for existing hashes.
+# KEYS: hashes, ARGV: field1, value1, field2, value2, ...
+# Return: number of updated hashes
+hset_existing = LazyScript('''
+local n = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HMSET', key, unpack(ARGV))
+        n = n + 1
+    end
+end
+return n
+''', split=True)
+
+
+# Members of id set with their blobs in one call.
+# Member keys are not declared, so it can not be used with sharded client.
+# KEYS: id set, ARGV: key prefix of members
+# Return: {{id1, id2, ...}, {blob1, blob2, ...}}, missing blob is nil
+get_members = LazyScript('''
+local ids = redis.call('SMEMBERS', KEYS[1])
+local blobs = {}
+local keys = {}
+for i, id in ipairs(ids) do
+    keys[#keys + 1] = ARGV[1] .. ':' .. id
+    if #keys == 1000 or i == #ids then
+        local chunk = redis.call('MGET', unpack(keys))
+        for j = 1, #keys do
+            blobs[#blobs + 1] = chunk[j]
+        end
+        keys = {}
+    end
+end
+return {ids, blobs}
+''', readonly=True)
+
+
+# Set value and register its key in tag sets. Tag set lives
+# at least as long as the longest entry registered in it.
+# Tables are registered in hash of tagged tables with time of
+# registration, value is set only if all tables are registered
+# for at least 'delay' seconds.
+# KEYS: tables hash, entry key, tag1, tag2, ...,
+# ARGV: value, timeout, now, delay, table1, table2, ...
+# Return: 1 if value is set, otherwise 0
+set_tagged = LazyScript('''
+local now = tonumber(ARGV[3])
+local ready = true
+for i = 5, #ARGV do
+    local since = redis.call('HGET', KEYS[1], ARGV[i])
+    if not since then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[3])
+        ready = false
+    elseif now - tonumber(since) < tonumber(ARGV[4]) then
+        ready = false
+    end
+end
+if not ready then
+    return 0
+end
+local timeout = tonumber(ARGV[2])
+redis.call('SETEX', KEYS[2], timeout, ARGV[1])
+for i = 3, #KEYS do
+    redis.call('SADD', KEYS[i], KEYS[2])
+    if redis.call('TTL', KEYS[i]) < timeout then
+        redis.call('EXPIRE', KEYS[i], timeout)
+    end
+end
+return 1
+''')
+
+
+# Delete entries registered in tag sets and tag sets themselves.
+# Entries and tags must be on one node (see 'tags.TAGGED').
+# KEYS: tag1, tag2, ...
+# Return: number of deleted entries
+invalidate_tags = LazyScript('''
+local n = 0
+for _, tag in ipairs(KEYS) do
+    local keys = redis.call('SMEMBERS', tag)
+    for i = 1, #keys, 1000 do
+        n = n + redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+    end
+    redis.call('DEL', tag)
+end
+return n
+''')
+
+
+# Add members only to existing sets.
+# KEYS: sets, ARGV: members
+# Return: number of updated sets
+sadd_existing = LazyScript('''
+local n = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('SADD', key, unpack(ARGV))
+        n = n + 1
+    end
+end
+return n
+''', split=True)
+
+
+# Members of index sets with their blobs in one call.
+# Member keys are not declared, so it can not be used with sharded client.
+# KEYS: index sets, ARGV: key prefix of members, marker member
+# Return: {exists1, {id, ...}, {blob, ...}, exists2, ...},
+#         marker is not returned, missing blob is nil
+get_groups = LazyScript('''
+local result = {}
+for _, set in ipairs(KEYS) do
+    local members = redis.call('SMEMBERS', set)
+    local ids = {}
+    local keys = {}
+    for _, id in ipairs(members) do
+        if id ~= ARGV[2] then
+            ids[#ids + 1] = id
+            keys[#keys + 1] = ARGV[1] .. ':' .. id
+        end
+    end
+    local blobs = {}
+    for i = 1, #keys, 1000 do
+        local chunk = redis.call('MGET', unpack(keys, i, math.min(i + 999, #keys)))
+        for j = 1, #chunk do
+            blobs[#blobs + 1] = chunk[j]
+        end
+    end
+    result[#result + 1] = #members > 0 and 1 or 0
+    result[#result + 1] = ids
+    result[#result + 1] = blobs
+end
+return result
+''', readonly=True)
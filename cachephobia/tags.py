@@ -0,0 +1,79 @@
+'''
+Tag sets of cache entries that depend on DB tables.
+Entry is registered in sets of every table it reads,
+write to table deletes all registered entries.
+Tables that ever had tagged entries are kept in a hash, processes
+read it every CACHEPHOBIA_DEFAULTS['generation_ttl'] seconds and
+invalidate only these tables, so writes of other tables cost nothing.
+New table gets entries only after every process has seen it.
+'''
+from time import time
+import six
+from .conf import settings
+from .redis import get_primary
+from .scripts import set_tagged, invalidate_tags
+
+
+# Hash tag of tagged entries and tag sets, it keeps
+# them on one node of sharded client for Lua scripts
+TAGGED = 'cp:{tagged}:'
+TABLES = TAGGED + 'tables'
+
+_tables = None
+_tables_expires = 0
+# Tables of models with CacheManager, only their writes invalidate tags
+_tracked = set()
+
+
+def tag_key(table):
+    return '%stag:%s' % (TAGGED, table)
+
+
+def track(table):
+    _tracked.add(table)
+
+
+def is_tracked(tables):
+    return _tracked.issuperset(tables)
+
+
+def _refresh_period():
+    return settings.CACHEPHOBIA_DEFAULTS.get('generation_ttl', 1)
+
+
+def tagged_tables():
+    '''
+    Return: set of tables with tagged entries, cached in process
+    '''
+    global _tables, _tables_expires
+    now = time()
+    if _tables is None or _tables_expires < now:
+        _tables = set(table.decode('utf-8') if isinstance(table, six.binary_type) else table
+                      for table in get_primary(TABLES).hkeys(TABLES))
+        _tables_expires = now + _refresh_period()
+    return _tables
+
+
+def set_with_tags(key, value, tables, timeout, client=None):
+    '''
+    Return: True if value is set, False if some of tables is just
+            registered and not yet known to other processes
+    '''
+    tables = sorted(tables)
+    # Doubled period leaves a margin for clock skew of hosts
+    return bool(set_tagged(keys=[TABLES, key] + [tag_key(table) for table in tables],
+                           args=[value, int(timeout), time(), 2 * _refresh_period()] + tables,
+                           client=client))
+
+
+def invalidate_tables(tables, client=None):
+    '''
+    Args: tables = DB table names,
+          client = redis client, pipeline or transaction Batch
+    Return: number of deleted entries (if executed immediately)
+    '''
+    known = tagged_tables()
+    tables = [table for table in tables if table in known]
+    if not tables:
+        return 0
+    return invalidate_tags(keys=[tag_key(table) for table in tables], client=client)
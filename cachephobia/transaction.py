@@ -0,0 +1,114 @@
+'''
+Cache mutations collected during DB transaction and sent
+in one pipeline on commit (dropped on rollback).
+'''
+from functools import partial
+from django.db import transaction
+from .redis import cache
+
+
+class Batch(object):
+    '''
+    Pipeline-like recorder of Redis commands.
+    Every command registers 'on_commit' callback that confirms it,
+    so commands made in rolled back savepoints are dropped by Django.
+    Flush callback is kept last in the list of commit callbacks and
+    outside of savepoints. It deduplicates confirmed commands per key
+    (commands that overwrite key drop earlier commands on that key)
+    and executes them in one pipeline.
+    '''
+    OVERWRITE = frozenset(('set', 'setex', 'delete'))
+
+    def __init__(self, using=None):
+        self.using = using
+        self.commands = []
+        self.confirmed = set()
+        self._flush = self.flush
+        self._entry = (set(), self._flush)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self._add, name)
+
+    def _add(self, name, *args, **kwargs):
+        if name == 'delete' and len(args) > 1:
+            for key in args:
+                self._add('delete', key)
+            return self
+
+        index = len(self.commands)
+        self.commands.append((name, args, kwargs))
+        transaction.on_commit(partial(self.confirmed.add, index), using=self.using)
+
+        # Django rebuilds entries on savepoint rollback,
+        # so entries are compared by callback
+        callbacks = transaction.get_connection(self.using).run_on_commit
+        if len(callbacks) > 1 and callbacks[-2][1] is self._flush:
+            callbacks[-2], callbacks[-1] = callbacks[-1], callbacks[-2]
+        else:
+            for i, entry in enumerate(callbacks):
+                if entry[1] is self._flush:
+                    del callbacks[i]
+                    break
+            callbacks.append(self._entry)
+        return self
+
+    def script(self, script, keys, args):
+        return self._add('script', script, keys, args)
+
+    def alive(self, connection):
+        '''
+        Return: False after rollback or flush
+        '''
+        callbacks = connection.run_on_commit
+        if callbacks and callbacks[-1][1] is self._flush:
+            return True
+        return any(entry[1] is self._flush for entry in callbacks)
+
+    def _deduplicated(self):
+        result = []
+        positions = {}
+        for index, command in enumerate(self.commands):
+            if index not in self.confirmed:
+                continue
+            name, args, kwargs = command
+            key = args[0] if args and name != 'script' else None
+            if name in self.OVERWRITE:
+                for position in positions.pop(key, ()):
+                    result[position] = None
+            positions.setdefault(key, []).append(len(result))
+            result.append(command)
+        return [command for command in result if command is not None]
+
+    def flush(self):
+        commands = self._deduplicated()
+        if not commands:
+            return []
+        pipe = cache.pipeline(transaction=False)
+        for name, args, kwargs in commands:
+            if name == 'script':
+                script, keys, script_args = args
+                script(keys=keys, args=script_args, client=pipe)
+            else:
+                getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()
+
+
+def get_batch(using=None):
+    '''
+    Return: Batch of current transaction or None
+            in autocommit mode (write immediately)
+    '''
+    if not hasattr(transaction, 'on_commit'):
+        return None
+
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return None
+
+    batch = getattr(connection, 'cp_batch', None)
+    if batch is None or batch.commands and not batch.alive(connection):
+        batch = Batch(using)
+        connection.cp_batch = batch
+    return batch
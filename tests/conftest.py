@@ -0,0 +1,12 @@
+import django
+from django.conf import settings
+
+
+if not settings.configured:
+    settings.configure(
+        SECRET_KEY='cachephobia',
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHEPHOBIA_REDIS={},
+    )
+    django.setup()
@@ -0,0 +1,118 @@
+from decimal import Decimal
+from uuid import UUID
+from unittest import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from cachephobia.codecs import (BinaryCodec, CodecError, ZlibCompressor, COMPRESSED,
+                                compress, decompress, get_codec, get_compressor)
+from cachephobia.query import CacheManager
+
+
+FIELDS = ('id', 'name', 'price', 'tags')
+
+
+class BinaryCodecTest(TestCase):
+
+    def setUp(self):
+        self.codec = BinaryCodec(FIELDS)
+
+    def test_round_trip(self):
+        values = {'id': 1, 'name': u'\u0417\u043e\u044f', 'price': -2.5, 'tags': [None, True, False, b'\x00\xff'],
+                  'extra': {'nested': 10 ** 12, 'negative': -300}}
+        self.assertEqual(self.codec.loads(self.codec.dumps(values)), values)
+
+    def test_round_trip_not_row(self):
+        values = {'1': {'id': 1, 'name': 'a', 'price': 0, 'tags': []}, '2': None}
+        self.assertEqual(self.codec.loads(self.codec.dumps(values)), values)
+
+    def test_row_is_positional(self):
+        row = {'id': 1, 'name': 'a', 'price': 0, 'tags': []}
+        self.assertNotIn(b'name', self.codec.dumps(row))
+        self.assertIn(b'name', self.codec.dumps({'name': 'a'}))
+
+    def test_decimal_and_uuid_as_str(self):
+        uuid = UUID('12345678123456781234567812345678')
+        values = self.codec.loads(self.codec.dumps({'price': Decimal('10.50'), 'uuid': uuid}))
+        self.assertEqual(values, {'price': '10.50', 'uuid': str(uuid)})
+
+    def test_unknown_type(self):
+        with self.assertRaises(CodecError):
+            self.codec.dumps({'value': object()})
+
+    def test_schema_mismatch(self):
+        data = BinaryCodec(FIELDS + ('new',)).dumps({'id': 1})
+        self.assertIsNone(self.codec.loads(data))
+
+    def test_version_mismatch(self):
+        data = bytearray(self.codec.dumps({'id': 1}))
+        data[2] = BinaryCodec.VERSION + 1
+        self.assertIsNone(self.codec.loads(bytes(data)))
+
+    def test_truncated(self):
+        data = self.codec.dumps({'id': 1, 'name': 'name', 'price': 1.5, 'tags': ['a', 'b']})
+        for size in range(len(data)):
+            with self.assertRaises(CodecError):
+                self.codec.loads(data[:size])
+
+    def test_not_binary_blob(self):
+        with self.assertRaises(CodecError):
+            self.codec.loads(b'{"id": 1, "name": "a"}')
+
+    def test_get_codec(self):
+        self.assertEqual(get_codec('json').loads(get_codec('json').dumps({'a': 1})), {'a': 1})
+        self.assertEqual(get_codec('binary', FIELDS).fields, FIELDS)
+        with self.assertRaises(ValueError):
+            get_codec('pickle')
+
+
+class SaveHookTest(TestCase):
+
+    def test_codec_error_drops_cached_value(self):
+        manager = mock.Mock()
+        manager._write.side_effect = [CodecError('Can not encode'), None]
+        instance = object()
+        CacheManager._post_save(manager, None, instance, using='default', created=False)
+        self.assertEqual(manager._write.call_args_list, [
+            mock.call('default', 'on_save', instance=instance, created=False),
+            mock.call('default', 'on_delete', instance=instance),
+        ])
+
+
+class CompressionTest(TestCase):
+
+    def setUp(self):
+        self.compressor = get_compressor('zlib')
+
+    def test_round_trip(self):
+        data = BinaryCodec(FIELDS).dumps({'name': 'a' * 1000})
+        packed = compress(data, 100, self.compressor)
+        self.assertTrue(packed.startswith(COMPRESSED + ZlibCompressor.id))
+        self.assertLess(len(packed), len(data))
+        self.assertEqual(decompress(packed), data)
+
+    def test_text_is_encoded(self):
+        data = '{"name": "%s"}' % ('a' * 1000)
+        self.assertEqual(decompress(compress(data, 100, self.compressor)), data.encode('utf-8'))
+
+    def test_below_threshold(self):
+        data = b'a' * 99
+        self.assertIs(compress(data, 100, self.compressor), data)
+        self.assertIs(compress(data, 0, self.compressor), data)
+        self.assertIs(decompress(data), data)
+
+    def test_incompressible(self):
+        data = bytes(bytearray(range(256)))
+        self.assertIs(compress(data, 100, self.compressor), data)
+
+    def test_corrupted(self):
+        packed = compress(b'a' * 1000, 100, self.compressor)
+        with self.assertRaises(CodecError):
+            decompress(packed[:-4])
+        with self.assertRaises(CodecError):
+            decompress(COMPRESSED + b'?' + packed[2:])
+
+    def test_unknown_compressor(self):
+        with self.assertRaises(ValueError):
+            get_compressor('bzip2')
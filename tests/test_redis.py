@@ -0,0 +1,148 @@
+from unittest import TestCase
+import redis
+from cachephobia.redis import ShardedRedis, hash_slot
+
+
+class Node(object):
+    '''
+    In-process stand-in of one Redis node.
+    '''
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def register_script(self, source):
+        def script(keys=[], args=[], client=None):
+            if client is not None:
+                client.command_stack.append((script, (), {'keys': keys, 'args': args}))
+                return client
+            # Script deletes its keys
+            self.calls.append(list(keys))
+            return self.delete(*keys)
+        return script
+
+
+class Pipeline(object):
+
+    def __init__(self, node):
+        self.node = node
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.command_stack.append((getattr(self.node, name), args, {}))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.command_stack = self.command_stack, []
+        return [func(*args, **kwargs) for func, args, kwargs in commands]
+
+
+KEYS = ['key:%d' % i for i in range(20000)]
+
+
+class HashRingTest(TestCase):
+
+    def make_client(self, size):
+        return ShardedRedis([Node() for i in range(size)],
+                            names=['node%d' % i for i in range(size)])
+
+    def test_hash_tag(self):
+        self.assertEqual(hash_slot('a:{user:1}:b'), hash_slot('user:1'))
+        self.assertEqual(hash_slot(u'a:{user:1}'), hash_slot(b'c:{user:1}:d'))
+        # Empty tag is not a tag
+        self.assertNotEqual(hash_slot('a:{}:b'), hash_slot('c:{}:d'))
+
+    def test_distribution(self):
+        client = self.make_client(4)
+        counts = [0] * 4
+        for key in KEYS:
+            counts[client.get_index(key)] += 1
+        for count in counts:
+            self.assertGreater(count, len(KEYS) * 0.15)
+            self.assertLess(count, len(KEYS) * 0.35)
+
+    def test_same_names_same_ring(self):
+        first, second = self.make_client(3), self.make_client(3)
+        self.assertEqual([first.get_index(key) for key in KEYS],
+                         [second.get_index(key) for key in KEYS])
+
+    def test_added_node(self):
+        before, after = self.make_client(4), self.make_client(5)
+        moved = 0
+        for key in KEYS:
+            index = before.get_index(key)
+            if after.get_index(key) != index:
+                # Keys move only to the new node
+                self.assertEqual(after.get_index(key), 4)
+                moved += 1
+        self.assertGreater(moved, len(KEYS) * 0.1)
+        self.assertLess(moved, len(KEYS) * 0.3)
+
+    def test_commands_by_key(self):
+        client = self.make_client(3)
+        for key in KEYS[:100]:
+            client.set(key, key)
+        for key in KEYS[:100]:
+            self.assertEqual(client.get_node(key).data[key], key)
+            self.assertEqual(client.get(key), key)
+        self.assertEqual(client.mget(KEYS[:100] + ['missing']), KEYS[:100] + [None])
+        self.assertEqual(client.delete(*KEYS[:50]), 50)
+        self.assertEqual(sum(len(node.data) for node in client.nodes), 50)
+
+
+class ShardedScriptTest(TestCase):
+
+    def setUp(self):
+        self.client = ShardedRedis([Node() for i in range(3)])
+        self.keys = KEYS[:30]
+        for key in self.keys:
+            self.client.set(key, 1)
+        self.script = self.client.register_script('delete keys')
+
+    def test_keys_on_different_nodes(self):
+        with self.assertRaises(redis.RedisError):
+            self.script(keys=self.keys)
+
+    def test_hash_tag(self):
+        keys = ['{tag}:%d' % i for i in range(10)]
+        for key in keys:
+            self.client.set(key, 1)
+        self.assertEqual(self.script(keys=keys), 10)
+        self.assertEqual([len(node.calls) for node in self.client.nodes].count(1), 1)
+
+    def test_split(self):
+        self.script.configure(split=True)
+        self.assertEqual(self.script(keys=self.keys), 30)
+        for index, node in enumerate(self.client.nodes):
+            for keys in node.calls:
+                self.assertTrue(keys)
+                self.assertEqual(set(self.client.get_index(key) for key in keys), {index})
+        self.assertEqual(sorted(key for node in self.client.nodes
+                                for keys in node.calls for key in keys), sorted(self.keys))
+
+    def test_split_in_pipeline(self):
+        self.script.configure(split=True)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self.keys[0])
+        self.script(keys=self.keys, client=pipe)
+        pipe.get(self.keys[0])
+        self.assertEqual(pipe.execute(), [1, 30, None])